@@ -49,7 +49,12 @@ class SftpToS3():
                 self.secrets_manager.getSftpCredsFromSecrets(
                     config.get('SECRET_ID'))
             )
-            sftp_client = SFTPClient(HOSTNAME, USERNAME, PASSWORD)
+            sftp_client = SFTPClient(
+                HOSTNAME, USERNAME, PASSWORD,
+                refresh_credentials=lambda secret_id=config.get('SECRET_ID'): (
+                    self.secrets_manager.getSftpCredsFromSecrets(secret_id, refresh=True)
+                )
+            )
 
             try:
                 # Listing of files from SFTP Path
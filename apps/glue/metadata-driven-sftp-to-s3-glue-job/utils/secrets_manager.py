@@ -3,9 +3,7 @@
 # or implementing the sample code, visit the AWS docs:
 # https://aws.amazon.com/developer/language/python/
 
-import json
-import boto3
-from botocore.exceptions import ClientError
+from utils.secrets_cache import secrets_cache
 from awsglue.utils import getResolvedOptions
 import sys
 
@@ -16,54 +14,22 @@ class SecretManager:
             sys.argv, ['snowflake_region'])
         self.region = self.args['snowflake_region']
 
-    def getSftpCredsFromSecrets(self, _secret_name: str):
+    def getSftpCredsFromSecrets(self, _secret_name: str, refresh: bool = False):
 
-        secret_name = _secret_name
-        region_name = self.region
-
-        # Create a Secrets Manager client
-        session = boto3.session.Session()
-        client = session.client(
-            service_name='secretsmanager',
-            region_name=region_name
-        )
-
-        try:
-            get_secret_value_response = client.get_secret_value(
-                SecretId=secret_name
-            )
-        except ClientError as e:
-            raise e
-
-        # Decrypts secret using the associated KMS key.
-        _secrets = json.loads(get_secret_value_response['SecretString'])
+        # Served from the process wide cache, one Secrets Manager call per secret and TTL
+        _secrets = secrets_cache.get(
+            _secret_name, region_name=self.region, refresh=refresh)
         _username = _secrets['username']
         _password = _secrets['password']
         _host = _secrets['hostname']
 
         return _username, _password, _host
 
-    def getSnowflakeCredsFromSecrets(self, _secret_name: str):
-
-        secret_name = _secret_name
-        region_name = self.region
-
-        # Create a Secrets Manager client
-        session = boto3.session.Session()
-        client = session.client(
-            service_name='secretsmanager',
-            region_name=region_name
-        )
-
-        try:
-            get_secret_value_response = client.get_secret_value(
-                SecretId=secret_name
-            )
-        except ClientError as e:
-            raise e
+    def getSnowflakeCredsFromSecrets(self, _secret_name: str, refresh: bool = False):
 
-        # Decrypts secret using the associated KMS key.
-        _secrets = json.loads(get_secret_value_response['SecretString'])
+        # Served from the process wide cache, one Secrets Manager call per secret and TTL
+        _secrets = secrets_cache.get(
+            _secret_name, region_name=self.region, refresh=refresh)
         _username = _secrets['user']
         _password = _secrets['password']
 
@@ -10,17 +10,32 @@ def progress_callback(transferred, total, file):
 
 
 class SFTPClient:
-    def __init__(self, HOSTNAME: str, USERNAME: str, PASSWORD: str):
+    def __init__(self, HOSTNAME: str, USERNAME: str, PASSWORD: str, refresh_credentials=None):
         self.hostname = HOSTNAME
         self.username = USERNAME
         self.password = PASSWORD
+        # Returns the current (username, password, hostname) from the secret, bypassing the cache
+        self.refresh_credentials = refresh_credentials
         self.SSHClient = paramiko.SSHClient()
 
-    def getListOfFilesFromPath(self, path: str):
-        with self.SSHClient as ssh_client:
-            ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    def _connect(self, ssh_client):
+        ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        try:
+            ssh_client.connect(hostname=self.hostname,
+                               username=self.username, password=self.password)
+        except paramiko.AuthenticationException as err:
+            if self.refresh_credentials is None:
+                raise
+            # The secret may have been rotated since it was cached, retry once with the current version
+            print(f"SFTP server rejected the cached credentials: {err}, refreshing the secret")
+            ssh_client.close()
+            self.username, self.password, self.hostname = self.refresh_credentials()
             ssh_client.connect(hostname=self.hostname,
                                username=self.username, password=self.password)
+
+    def getListOfFilesFromPath(self, path: str):
+        with self.SSHClient as ssh_client:
+            self._connect(ssh_client)
             with ssh_client.open_sftp() as sftp_client:
                 sftp_client.chdir(path)
                 files = sftp_client.listdir()
@@ -29,9 +44,7 @@ class SFTPClient:
     def transferFilesToLocal(self, sftp_file_path, localFilePath, is_debug=False):
         file_to_process = f"{sftp_file_path} to {localFilePath}"
         with self.SSHClient as ssh_client:
-            ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            ssh_client.connect(hostname=self.hostname,
-                               username=self.username, password=self.password)
+            self._connect(ssh_client)
             with ssh_client.open_sftp() as sftp_client:
                 if is_debug:
                     sftp_client.get(
@@ -48,9 +61,7 @@ class SFTPClient:
 
     def getFileTimestampInSFTP(self, sftp_file_path):
         with self.SSHClient as ssh_client:
-            ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            ssh_client.connect(hostname=self.hostname,
-                               username=self.username, password=self.password)
+            self._connect(ssh_client)
             with ssh_client.open_sftp() as sftp_client:
                 file_ts = str(datetime.fromtimestamp(
                     sftp_client.stat(sftp_file_path).st_mtime))
@@ -58,9 +69,7 @@ class SFTPClient:
 
     def sortFilesBasedOnLastModifiedDate(self, files, desc=True):
         with self.SSHClient as ssh_client:
-            ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            ssh_client.connect(hostname=self.hostname,
-                               username=self.username, password=self.password)
+            self._connect(ssh_client)
             with ssh_client.open_sftp() as sftp_client:
                 if desc:
                     sorted_files = sorted(
@@ -73,9 +82,7 @@ class SFTPClient:
     def removeOldFilesFromListByCutoffDt(self, files, cutoff_dt):
         cutoff_dt = datetime.strptime(cutoff_dt, '%Y-%m-%d %H:%M:%S')
         with self.SSHClient as ssh_client:
-            ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            ssh_client.connect(hostname=self.hostname,
-                               username=self.username, password=self.password)
+            self._connect(ssh_client)
             with ssh_client.open_sftp() as sftp_client:
                 new_files = [
                     new_file for new_file in files if datetime.strptime(str(datetime.fromtimestamp(
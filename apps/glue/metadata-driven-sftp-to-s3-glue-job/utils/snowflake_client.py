@@ -2,6 +2,7 @@ import snowflake.connector as snowflake_conn
 import json
 from snowflake.connector import ProgrammingError, DictCursor
 from utils.secrets_manager import SecretManager
+from utils.secrets_cache import is_authentication_error
 from datetime import datetime
 from awsglue.utils import getResolvedOptions
 import sys
@@ -21,33 +22,43 @@ class SnowflakeClient:
         }.get(self.environment.upper(), None)
         self.db = db
         self.schema = schema
-        secrets_manager = SecretManager()
+        self.secret_name = f"tmr-dp-{self.environment}/snowflake-secrets"
+        self.secrets_manager = SecretManager()
         self.user, self.password = (
-            secrets_manager.getSnowflakeCredsFromSecrets(
-                f"tmr-dp-{self.environment}/snowflake-secrets")
+            self.secrets_manager.getSnowflakeCredsFromSecrets(self.secret_name)
         )
         self.event_dict = self.createInitialJsonEvent()
 
-    def getDataFromTable(self, query: str):
-        with snowflake_conn.connect(
+    def _connect(self):
+        try:
+            return self._open_connection()
+        except Exception as err:
+            if not is_authentication_error(err):
+                raise
+            # The secret may have been rotated since it was cached, retry once with the current version
+            print(f"Snowflake rejected the cached credentials: {err}, refreshing the secret")
+            self.user, self.password = (
+                self.secrets_manager.getSnowflakeCredsFromSecrets(
+                    self.secret_name, refresh=True)
+            )
+            return self._open_connection()
+
+    def _open_connection(self):
+        return snowflake_conn.connect(
             account=self.account,
             warehouse=self.warehouse,
             database=self.db,
             schema=self.schema,
             user=self.user,
             password=self.password
-        ) as sf_conn:
+        )
+
+    def getDataFromTable(self, query: str):
+        with self._connect() as sf_conn:
             return sf_conn.cursor(DictCursor).execute(query).fetchall()
 
     def getLatestExecutionId(self):
-        with snowflake_conn.connect(
-            account=self.account,
-            warehouse=self.warehouse,
-            database=self.db,
-            schema=self.schema,
-            user=self.user,
-            password=self.password
-        ) as sf_conn:
+        with self._connect() as sf_conn:
             query = f"""
                     SELECT CAST(ZEROIFNULL(MAX(execution_id)) AS INT) + 1 AS MAX_EXEC_ID
                     FROM {self.events_table}
@@ -55,14 +66,7 @@ class SnowflakeClient:
             return sf_conn.cursor(DictCursor).execute(query).fetchone().get('MAX_EXEC_ID')
 
     def getFileTsInLogs(self, file_name):
-        with snowflake_conn.connect(
-            account=self.account,
-            warehouse=self.warehouse,
-            database=self.db,
-            schema=self.schema,
-            user=self.user,
-            password=self.password
-        ) as sf_conn:
+        with self._connect() as sf_conn:
             query = f"""
                     SELECT MAX(FILE_TIMESTAMP) AS FILE_TIMESTAMP
                     FROM {self.events_table}
@@ -75,14 +79,7 @@ class SnowflakeClient:
             return str(file_ts)
 
     def getLatestTimestampBySourceNameAndGenericFilename(self, source_name, generic_file_name):
-        with snowflake_conn.connect(
-            account=self.account,
-            warehouse=self.warehouse,
-            database=self.db,
-            schema=self.schema,
-            user=self.user,
-            password=self.password
-        ) as sf_conn:
+        with self._connect() as sf_conn:
             query = f"""
                     SELECT MAX(file_timestamp) as LAST_PROCESSED_TS
                     FROM  {self.events_table}
@@ -95,14 +92,7 @@ class SnowflakeClient:
             return str(latest_ts)
 
     def isFileExists(self, file_path):
-        with snowflake_conn.connect(
-            account=self.account,
-            warehouse=self.warehouse,
-            database=self.db,
-            schema=self.schema,
-            user=self.user,
-            password=self.password
-        ) as sf_conn:
+        with self._connect() as sf_conn:
             query = f"""
                     SELECT CONCAT(file_path, '/',file_name) AS FILE_FULL_PATH
                     FROM {self.events_table}
@@ -151,14 +141,7 @@ class SnowflakeClient:
         ) else self.event_dict['FILE_TIMESTAMP']
 
     def logFileAuditEvent(self):
-        with snowflake_conn.connect(
-            account=self.account,
-            warehouse=self.warehouse,
-            database=self.db,
-            schema=self.schema,
-            user=self.user,
-            password=self.password
-        ) as sf_conn:
+        with self._connect() as sf_conn:
             json_event = (
                 json.loads(json.dumps(self.event_dict))
             )
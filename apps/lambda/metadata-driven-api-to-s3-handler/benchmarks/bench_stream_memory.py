@@ -0,0 +1,134 @@
+# Measures the peak memory of converting a JSON API response to CSV in S3, buffered (response.text, json.loads and
+# write_to_s3_smart_v2 over the list) against stream_json_to_s3, for growing response sizes.
+#
+#   python benchmarks/bench_stream_memory.py --records 100000 1000000 3000000
+#
+# The response is generated on the fly by a local http.server stub running in its own process, so the stub's memory
+# is not counted. Every measurement runs in a fresh interpreter and reports the growth of its peak RSS over the
+# baseline after imports. Uploads go to an S3 stand-in that reads and discards the parts smart_open sends.
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import subprocess
+import sys
+import time
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from urllib.parse import parse_qs
+from urllib.parse import urlparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    # GET /records?n=N returns {"meta": {"total": N}, "data": [...]} with N nested records, written in chunks
+
+    def do_GET(self):
+        count = int(parse_qs(urlparse(self.path).query).get("n", ["1000"])[0])
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.end_headers()
+        self.wfile.write(json.dumps({"meta": {"total": count}}).encode()[:-1] + b', "data": [')
+        chunk = []
+        for index in range(count):
+            chunk.append(json.dumps({"id": index, "name": f"record {index}", "amount": index * 1.5,
+                                     "customer": {"id": index % 977, "region": "QLD"},
+                                     "tags": ["a", "b"]}))
+            if len(chunk) == 1000 or index == count - 1:
+                self.wfile.write((", " if index >= 1000 else "").encode() + ", ".join(chunk).encode())
+                chunk = []
+        self.wfile.write(b"]}")
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(port_queue):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    port_queue.put(server.server_port)
+    server.serve_forever()
+
+
+class DiscardS3:
+    # Minimal client for smart_open's writer, part bodies are read and dropped
+
+    def __init__(self):
+        self.bytes_uploaded = 0
+
+    def _consume(self, body):
+        self.bytes_uploaded += len(body if isinstance(body, (bytes, bytearray)) else body.read())
+
+    def put_object(self, Bucket, Key, Body=b"", **kwargs):
+        self._consume(Body)
+        return {}
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        return {"UploadId": "bench"}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body, **kwargs):
+        self._consume(Body)
+        return {"ETag": f'"{PartNumber}"'}
+
+    def complete_multipart_upload(self, **kwargs):
+        return {}
+
+    def abort_multipart_upload(self, **kwargs):
+        return {}
+
+
+def measure(mode, count, port):
+    # runs in the child interpreter
+    import logging
+    import requests
+    import lambda_runner
+    logging.getLogger().setLevel(logging.WARNING)
+    s3 = DiscardS3()
+    session = requests.Session()
+    event = {"query_params": {"n": count}, "records_path": "data", "landing_bucket_path": "bench/landing",
+             "file_type": "json", "pagination": "_NA", "stream": mode == "stream"}
+    url = f"http://127.0.0.1:{port}/records"
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    started = time.monotonic()
+    if mode == "stream":
+        lambda_runner.stream_json_to_s3(session, url, event, "bench.csv", s3)
+    else:
+        records = [lambda_runner.flatten_record(record)
+                   for record in json.loads(lambda_runner.send_request(session, url, event))["data"]]
+        lambda_runner.write_to_s3_smart_v2(event=event, payload=records, file_name="bench.csv", s3_client=s3,
+                                           keys=list(records[0].keys()), as_records=True)
+    elapsed = time.monotonic() - started
+    peak = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline) / 1024
+    print(json.dumps({"elapsed": elapsed, "peak_mb": peak, "uploaded_mb": s3.bytes_uploaded / 1024 / 1024}))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--records", type=int, nargs="+", default=[100000, 1000000])
+    parser.add_argument("--modes", default="buffered,stream")
+    parser.add_argument("--child", nargs=3, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        measure(args.child[0], int(args.child[1]), int(args.child[2]))
+        return
+
+    port_queue = multiprocessing.Queue()
+    server = multiprocessing.Process(target=serve, args=(port_queue,), daemon=True)
+    server.start()
+    port = port_queue.get()
+    try:
+        print(f"{'records':>10} {'mode':>9} {'csv MB':>8} {'peak RSS MB':>12} {'seconds':>8}")
+        for count in args.records:
+            for mode in args.modes.split(","):
+                output = subprocess.run([sys.executable, os.path.abspath(__file__), "--child", mode, str(count),
+                                         str(port)], capture_output=True, text=True, check=True).stdout
+                result = json.loads(output.strip().splitlines()[-1])
+                print(f"{count:>10} {mode:>9} {result['uploaded_mb']:>8.1f} {result['peak_mb']:>12.1f} "
+                      f"{result['elapsed']:>8.2f}")
+    finally:
+        server.terminate()
+
+
+if __name__ == "__main__":
+    main()
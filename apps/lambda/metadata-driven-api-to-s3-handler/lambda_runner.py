@@ -1,14 +1,27 @@
 import json
+import hashlib
 import requests
 import boto3
 import jmespath
+import ijson
 from urllib.parse import urlparse, parse_qs
 import pandas
 import smart_open
 import time
+import math
+import random
 import csv
 import io
+import itertools
+import threading
+from contextlib import contextmanager
 from zipfile import ZipFile
+from concurrent.futures import ThreadPoolExecutor, FIRST_EXCEPTION, wait
+from requests.adapters import HTTPAdapter
+
+from secrets_cache import secrets_cache
+from token_cache import BearerTokenAuth
+from token_cache import token_cache
 
 from datetime import datetime
 from dateutil import tz
@@ -21,41 +34,37 @@ logger.setLevel(logging.INFO)
 
 
 # Retrieve API Credentials
-def retrieve_api_credentials(event):
+def retrieve_api_credentials(event, refresh=False):
     ''' Extracts securely stored secrets from Secret Manager
     
     Args:
         event (dict): payload from airflow which contains all information / 
             configuration required to ingest data from the specified endpoint
+        refresh (bool): Fetch the secret again, e.g. after the API rejected it
             
     Returns:
         dict: Secret values stored in a dictionary
     '''
-    # Secrets manager client
-    secretsmanager = boto3.client(service_name='secretsmanager', region_name='ap-southeast-2')
-    
-    #Extract secret
-    sm_response = secretsmanager.get_secret_value(SecretId=event['secret_id'],)
-    secretDict = json.loads(sm_response['SecretString'])
+    # Served from the process wide cache, so warm invocations do not call Secrets Manager again within the TTL
+    secretDict = secrets_cache.get(event['secret_id'], region_name='ap-southeast-2', refresh=refresh)
     
     return secretDict
 
-# Define a session to make HTTP requests
-def define_session(event, secretDict):
-    ''' Defines a HTTP session object to persist parameters across requests
+# Set BasicAuth / APIKey credentials on a session
+def apply_static_credentials(session, event, secretDict):
+    ''' Sets the credentials of the BasicAuth and APIKey methods on the session,
+        also used to replace them once a rotated secret was fetched again
     
     Args:
+        session (object): Containing persistent request parameters
         event (dict): payload from airflow which contains all information / 
             configuration required to ingest data from the specified endpoint
         secretDict (dict): Secret values stored in a dictionary
             
     Returns:
-        Session Object
+        None
     '''
     
-    # Create session and update headers and authentication as defined in config
-    session = requests.Session()
-    session.headers.update(event['headers'])
     if event['auth_method'] == 'BasicAuth':
         logger.info('Performing BasicAuth')
         session.auth = (secretDict['username'],secretDict['password'])
@@ -63,66 +72,120 @@ def define_session(event, secretDict):
     if event['auth_method'] == 'APIKey':
         logger.info('Performing APIKey')
         session.params =(secretDict)
+
+# Define a session to make HTTP requests
+def define_session(event, secretDict):
+    ''' Defines a HTTP session object to persist parameters across requests
+    
+    Args:
+        event (dict): payload from airflow which contains all information / 
+            configuration required to ingest data from the specified endpoint
+        secretDict (dict): Secret values stored in a dictionary
+            
+    Returns:
+        Session Object
+    '''
+    
+    # Create session and update headers and authentication as defined in config
+    session = requests.Session()
+    session.headers.update(event['headers'])
+    apply_static_credentials(session, event, secretDict)
         
     if event['auth_method'] == 'OAuth2_client_credentials':
-        logger.info(f'''[LAMBDA LOG] - Attempting to perfom OAuth2_client_credentials authenticatation with the following details:
-            - client_id: {secretDict['client_id']}
-            - client_secret: ######################
-            - scope: {secretDict['scope']}
-            ''')
+        # Only called when the cache holds no usable token for this secret and auth method, the secret is read at
+        # exchange time so a refresh after a rejection uses the rotated client secret
+        def exchange():
+            secretDict = retrieve_api_credentials(event)
+            logger.info(f'''[LAMBDA LOG] - Attempting to perfom OAuth2_client_credentials authenticatation with the following details:
+                - client_id: {secretDict['client_id']}
+                - client_secret: ######################
+                - scope: {secretDict['scope']}
+                ''')
         
-        token_data = {
-            'grant_type': 'client_credentials',
-            'client_id': secretDict['client_id'],
-            'client_secret': secretDict['client_secret'],
-            'scope': secretDict['scope']
-            }
-
-        token_r = requests.post(secretDict['access_token_url'], data=token_data, verify=False)
-        token_r_json = token_r.json()
-        token = token_r_json['access_token']
-        api_call_headers = {'Authorization': 'Bearer ' + token}
-        session.headers.update(api_call_headers)
+            token_data = {
+                'grant_type': 'client_credentials',
+                'client_id': secretDict['client_id'],
+                'client_secret': secretDict['client_secret'],
+                'scope': secretDict['scope']
+                }
+
+            token_r = requests.post(secretDict['access_token_url'], data=token_data, verify=False)
+            token_r_json = token_r.json()
+            return token_r_json['access_token'], token_r_json.get('expires_in')
+        
+        session.auth = BearerTokenAuth(token_cache, (event['secret_id'], event['auth_method']), exchange)
     
     if event['auth_method'] == 'OAuth2_SAML_assertion':
-        logger.info(f'''[LAMBDA LOG] - Attempting to authenticate with the following details:
-            - client_id: {secretDict['client_id']}
-            - token_url: {secretDict['token_url']}
-            - token_url_body: {secretDict['token_url_body']}
-            - idp_url: {secretDict['idp_url']}
-            - private_key: ######################
-            - grant_type: {secretDict['grant_type']}
-            - company_id: {secretDict['company_id']}
-            ''')
+        # Both round trips, to the IdP and the token endpoint, are skipped while the cached token is valid
+        def exchange():
+            secretDict = retrieve_api_credentials(event)
+            logger.info(f'''[LAMBDA LOG] - Attempting to authenticate with the following details:
+                - client_id: {secretDict['client_id']}
+                - token_url: {secretDict['token_url']}
+                - token_url_body: {secretDict['token_url_body']}
+                - idp_url: {secretDict['idp_url']}
+                - private_key: ######################
+                - grant_type: {secretDict['grant_type']}
+                - company_id: {secretDict['company_id']}
+                ''')
+        
+            saml_assertion_data = {
+                'client_id': secretDict['client_id'],
+                'token_url': secretDict['token_url_body'],
+                'private_key': secretDict['private_key'],
+                'user_id': secretDict['user_id']
+                }
         
-        saml_assertion_data = {
-            'client_id': secretDict['client_id'],
-            'token_url': secretDict['token_url_body'],
-            'private_key': secretDict['private_key'],
-            'user_id': secretDict['user_id']
-            }
+            headers_auth = {'Content-Type': 'application/x-www-form-urlencoded'}
+            saml_assertion_payload = requests.post(secretDict['idp_url'], data=saml_assertion_data, headers=headers_auth, verify=False)
+            saml_assertion = saml_assertion_payload.text
+
+            token_data = {
+                'client_id': secretDict['client_id'],
+                'grant_type': secretDict['grant_type'],
+                'company_id': secretDict['company_id'],
+                'assertion': saml_assertion
+                }
+
+            access_token_payload = requests.post(secretDict['token_url'], data=token_data, headers=headers_auth, verify=False)
+            access_token = access_token_payload.json()
+            return access_token['access_token'], access_token.get('expires_in')
         
-        headers_auth = {'Content-Type': 'application/x-www-form-urlencoded'}
-        saml_assertion_payload = requests.post(secretDict['idp_url'], data=saml_assertion_data, headers=headers_auth, verify=False)
-        saml_assertion = saml_assertion_payload.text
-
-        token_data = {
-            'client_id': secretDict['client_id'],
-            'grant_type': secretDict['grant_type'],
-            'company_id': secretDict['company_id'],
-            'assertion': saml_assertion
-            }
-
-        access_token_payload = requests.post(secretDict['token_url'], data=token_data, headers=headers_auth, verify=False)
-        access_token = access_token_payload.json()
-        token = access_token['access_token']
-        api_call_headers = {'Authorization': 'Bearer ' + token}
-        session.headers.update(api_call_headers)
+        session.auth = BearerTokenAuth(token_cache, (event['secret_id'], event['auth_method']), exchange)
     
     return session
 
+# Refresh credentials the API rejected
+def refresh_credentials(session, event, status_code):
+    ''' Refreshes the credentials of the session after a rejected request
+    
+    A cached OAuth token can be revoked before it expires and a rotated secret is
+    served from the cache until its TTL, so on a 401 (or a 403 for BasicAuth and
+    APIKey) the secret is fetched again and the token exchanged again.
+    
+    Args:
+        session (object): Containing persistent request parameters
+        event (dict): Payload from airflow which contains all information / 
+            configuration required to ingest data from the specified endpoint
+        status_code (int): Status code of the rejected response
+            
+    Returns:
+        bool: True when the credentials were refreshed and the request should be retried
+    '''
+    
+    if status_code == 401 and isinstance(session.auth, BearerTokenAuth):
+        logger.info('[LAMBDA LOG] - Token rejected with 401, re-authenticating')
+        retrieve_api_credentials(event, refresh=True)
+        session.auth.refresh()
+        return True
+    if status_code in (401, 403) and event['auth_method'] in ('BasicAuth', 'APIKey'):
+        logger.info(f'[LAMBDA LOG] - Credentials rejected with {status_code}, refreshing the secret')
+        apply_static_credentials(session, event, retrieve_api_credentials(event, refresh=True))
+        return True
+    return False
+
 # Function to make API call
-def send_request(session, url, event):
+def send_request(session, url, event, strict=False):
     ''' Defines a requests to the specified endpoint and returns the payload in
             JSON format
     
@@ -131,6 +194,11 @@ def send_request(session, url, event):
             configuration required to ingest data from the specified endpoint
         session (object): Containing persistent request parameters
         url (str): Endpoint to extract data from
+        strict (bool): Retry throttled and unavailable responses (429, 502, 503,
+            504) up to event['max_attempts'] (default 5) times with exponential
+            backoff from event['backoff_seconds'] (default 1), honouring
+            Retry-After, and raise on any response other than 200 so an error
+            body is never taken for data
             
     Returns:
         JSON Payload (list): JSON object returned as a list of dicts
@@ -138,12 +206,27 @@ def send_request(session, url, event):
     
     logger.info("-------")
 
-    # Send HTTP request updating parameters as defined in config
-    response = session.get(url, verify=False, params = event['query_params'])
+    max_attempts = int(event.get('max_attempts', 5)) if strict else 1
+    for attempt in range(1, max_attempts + 1):
+        # Send HTTP request updating parameters as defined in config
+        response = session.get(url, verify=False, params = event['query_params'])
+        if refresh_credentials(session, event, response.status_code):
+            response = session.get(url, verify=False, params = event['query_params'])
+        if response.status_code not in (429, 502, 503, 504) or attempt == max_attempts:
+            break
+        retry_after = response.headers.get('Retry-After', '')
+        delay = float(retry_after) if retry_after.isdigit() else random.uniform(0, float(event.get('backoff_seconds', 1)) * 2 ** (attempt - 1))
+        logger.info(f'[LAMBDA LOG] - Request to {url} with query parameters {event["query_params"]} returned {response.status_code}, attempt {attempt} of {max_attempts}, retrying in {delay:.2f}s')
+        time.sleep(min(delay, 60))
     logger.info(f"[LAMBDA LOG] - Attempting to query the following URL {url} with query parameters {event['query_params']}")
+    # Still rejected with fresh credentials, the error body must not be landed as data
+    if response.status_code in (401, 403):
+        raise Exception(f'Request to {url} was rejected with status code {response.status_code} after refreshing the credentials: {response.text[:1000]}')
     if response.status_code != 200:
         logger.info('[LAMBDA LOG] - ERROR RECEIVING PAYLOAD')
         logger.info(f'[LAMBDA LOG] - Response body {response.text}')
+        if strict:
+            raise Exception(f'Request to {url} with query parameters {event["query_params"]} failed with status code {response.status_code}: {response.text[:1000]}')
     
     
     if event['pagination'] == 'Daisy':
@@ -171,6 +254,92 @@ def send_request(session, url, event):
         logger.info(f'[LAMBDA LOG] - Returned json Response')
     return response.text
 
+# Flatten a nested JSON record into a single level dict
+def flatten_record(record, separator='.', prefix=''):
+    ''' Flattens nested objects into keys joined by the separator, lists are
+        kept as JSON strings so every record maps to one CSV row
+    
+    Args:
+        record (dict): JSON record as parsed by ijson
+        separator (str): Joins the keys of nested objects
+        prefix (str): Key of the enclosing object
+            
+    Returns:
+        dict: Single level record
+    '''
+    
+    flat = {}
+    for key, value in record.items():
+        name = f'{prefix}{separator}{key}' if prefix else key
+        if isinstance(value, dict):
+            flat.update(flatten_record(value, separator, name))
+        elif isinstance(value, list):
+            flat[name] = json.dumps(value, default=str)
+        else:
+            flat[name] = value
+    return flat
+
+# Stream a JSON response into a CSV file in S3
+def stream_json_to_s3(session, url, event, file_name, s3_client, pinned_schema=None):
+    ''' Streams a JSON response into a CSV file in S3 without holding the
+        response in memory
+    
+    The body is read with stream=True and parsed incrementally by ijson, the
+    records of the array at event['records_path'] (a dotted path, default the
+    top level array) are flattened as they are parsed and written through the
+    smart_open multipart writer, so peak memory does not depend on the size of
+    the response. The columns are event['columns'] or the keys of the first
+    record, fields of later records outside them are dropped and counted.
+    
+    Args:
+        session (object): Containing persistent request parameters
+        url (str): Endpoint to extract data from
+        event (dict): Payload from airflow which contains all information / 
+            configuration required to ingest data from the specified endpoint
+        file_name (str): Object name to be used when storing data in S3
+        s3_client (client): A low-level client representing Amazon Simple Storage Service (S3)
+        pinned_schema (PinnedSchema): Schema shared by the Parquet files of the invocation
+            
+    Returns:
+        None, or 'No data' when the response holds no records
+    '''
+    
+    logger.info(f"[LAMBDA LOG] - Attempting to stream the following URL {url} with query parameters {event['query_params']}")
+    separator = event.get('flatten_separator', '.')
+    prefix = f"{event['records_path']}.item" if event.get('records_path') else 'item'
+    response = session.get(url, verify=False, params=event['query_params'], stream=True)
+    if refresh_credentials(session, event, response.status_code):
+        response.close()
+        response = session.get(url, verify=False, params=event['query_params'], stream=True)
+    with response:
+        if response.status_code != 200:
+            logger.info('[LAMBDA LOG] - ERROR RECEIVING PAYLOAD')
+            raise Exception(f'Request to {url} failed with status code {response.status_code}: {response.text[:1000]}')
+        # Let urllib3 undo gzip / deflate transfer encoding while ijson reads the raw stream
+        response.raw.decode_content = True
+        # Parquet columns need one type per column, so numbers are parsed as floats instead of exact decimals
+        records = (flatten_record(record, separator) for record in
+                   ijson.items(response.raw, prefix, use_float=event.get('output_format') == 'parquet'))
+        first_record = next(records, None)
+        if first_record is None:
+            logger.info(f'[LAMBDA LOG] - No data to ingest')
+            return 'No data'
+        keys = event.get('columns') or list(first_record.keys())
+        dropped = [0]
+        
+        def counted(records):
+            for record in records:
+                if record.keys() - set(keys):
+                    dropped[0] += 1
+                yield record
+        
+        write_to_s3_smart_v2(event=event, payload=counted(itertools.chain([first_record], records)),
+                             file_name=file_name, s3_client=s3_client, keys=keys, extrasaction='ignore', as_records=True,
+                             pinned_schema=pinned_schema)
+    if dropped[0]:
+        logger.warning(f'[LAMBDA LOG] - {dropped[0]} records had fields outside the columns {keys}, set columns in the config to keep them')
+    return None
+
 # Write data to S3 using put_object() method
 def write_to_s3(payload, file_name, s3_client, event):
     ''' Writes data to S3
@@ -205,8 +374,164 @@ def write_to_s3(payload, file_name, s3_client, event):
     logger.info(f'[LAMBDA LOG] - Successfully pushed {str(records_count)} records to S3')
     return None
 
+# Parquet schema shared by the files of one invocation
+class PinnedSchema:
+    ''' Holds the Arrow schema every Parquet file of an invocation is written with
+    
+    The first file to need a schema pins it, either from event['parquet_schema']
+    ({column: Arrow type alias}, which also keeps Daisy continuations on the same
+    schema) or inferred from its first row group. Concurrent Paged writers share
+    the instance, so the first pin wins.
+    '''
+    
+    def __init__(self):
+        self.schema = None
+        self._lock = threading.Lock()
+    
+    def pin(self, infer):
+        with self._lock:
+            if self.schema is None:
+                self.schema = infer()
+            return self.schema
+
+# Write records as Parquet
+def write_parquet(event, payload, target, keys=[], update_dict={}, extrasaction='raise', pinned_schema=None):
+    ''' Writes records to a binary file object as Parquet, one row group at a time
+    
+    Records are accumulated into row groups of event['parquet_row_group_rows']
+    (default 50000) rows and written with the schema pinned by pinned_schema.
+    An inferred schema types columns of integers as int64, columns holding any
+    float as float64 and columns that are only null as string, set
+    event['parquet_schema'] to widen a column ahead of the data. Values are only
+    widened from integer to float, any other value that does not fit its column
+    (e.g. 2.5 in an int64 column) raises, as do record fields outside the
+    columns unless extrasaction is 'ignore'. pyarrow is imported on first use, so
+    it is only needed in the deployment package (or a layer) when output_format
+    is parquet.
+    
+    Args:
+        event (dict): Payload from airflow which contains all information / 
+            configuration required to ingest data from the specified endpoint
+        payload (iterable): Records to write, a list or a generator of dicts
+        target (object): Binary file object, e.g. a smart_open S3 writer
+        keys (dict): Columns to write, the pinned schema's columns when empty
+        update_dict (dict): Values added to every record
+        extrasaction (str): 'ignore' drops record fields outside keys instead of raising
+        pinned_schema (PinnedSchema): Schema shared with the other files of the invocation
+            
+    Returns:
+        int: Number of records written
+    '''
+    
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    
+    row_group_rows = int(event.get('parquet_row_group_rows', 50000))
+    columns = list(keys) + [key for key in update_dict if key not in keys] if keys else None
+    pinned_schema = pinned_schema or PinnedSchema()
+    writer = None
+    count_row = 0
+    rows = []
+    
+    def infer(rows):
+        if event.get('parquet_schema'):
+            return pa.schema([pa.field(name, pa.type_for_alias(type_name)) for name, type_name in event['parquet_schema'].items()])
+        names = columns or list(dict.fromkeys(name for row in rows for name in row))
+        fields = []
+        for name in names:
+            try:
+                field_type = pa.array([row.get(name) for row in rows]).type
+            except (pa.ArrowInvalid, pa.ArrowTypeError, TypeError) as ex:
+                raise Exception(f'Column {name} mixes types in the first row group, its schema can not be inferred: {ex}')
+            if pa.types.is_null(field_type):
+                field_type = pa.string()
+            elif pa.types.is_integer(field_type):
+                # integers stay exact, ids above 2^53 do not survive a float64, a column that also holds floats
+                # in the first row group is already inferred as double
+                field_type = pa.int64()
+            fields.append(pa.field(name, field_type))
+        return pa.schema(fields)
+    
+    def to_table(rows, schema):
+        first_row = count_row - len(rows)
+        unknown = set(name for row in rows for name in row) - set(schema.names)
+        if unknown:
+            raise Exception(f'Records {first_row} to {count_row} have fields {sorted(unknown)} outside the pinned schema {schema.names}')
+        arrays = []
+        for field in schema:
+            try:
+                array = pa.array([row.get(field.name) for row in rows])
+                if array.type != field.type:
+                    numeric = (pa.types.is_integer(array.type) or pa.types.is_floating(array.type)) and \
+                        (pa.types.is_integer(field.type) or pa.types.is_floating(field.type))
+                    if not (pa.types.is_null(array.type) or numeric):
+                        raise TypeError(f'found {array.type} values')
+                    # safe casts raise instead of truncating, e.g. 2.5 into an integer column
+                    array = array.cast(field.type, safe=True)
+            except (pa.ArrowInvalid, pa.ArrowTypeError, TypeError) as ex:
+                raise Exception(f'Column {field.name} of records {first_row} to {count_row} does not fit {field.type} of the pinned schema: {ex}')
+            arrays.append(array)
+        return pa.Table.from_arrays(arrays, schema=schema)
+    
+    def flush(rows, writer):
+        schema = pinned_schema.pin(lambda: infer(rows))
+        if writer is None:
+            writer = pq.ParquetWriter(target, schema, compression=event.get('parquet_compression', 'snappy'))
+        writer.write_table(to_table(rows, schema))
+        return writer
+    
+    try:
+        for data in payload:
+            record = {**data, **update_dict}
+            if columns:
+                if extrasaction == 'raise' and record.keys() - set(columns):
+                    raise Exception(f'Record {count_row} has fields {sorted(record.keys() - set(columns))} outside the columns {columns}')
+                record = {column: record.get(column) for column in columns}
+            rows.append(record)
+            count_row += 1
+            if len(rows) >= row_group_rows:
+                writer = flush(rows, writer)
+                rows = []
+        if rows:
+            writer = flush(rows, writer)
+        elif writer is None:
+            # Without records the file carries the pinned columns, or the configured ones typed as string
+            schema = pinned_schema.schema or pa.schema([pa.field(column, pa.string()) for column in columns or []])
+            writer = pq.ParquetWriter(target, schema, compression=event.get('parquet_compression', 'snappy'))
+    finally:
+        if writer is not None:
+            writer.close()
+    return count_row
+
+# Open a binary smart_open writer that only completes the upload on success
+@contextmanager
+def open_s3_writer(url, transport_params):
+    ''' Opens a binary smart_open writer to S3 and completes the upload when the
+        block exits normally
+    
+    The text wrapper of smart_open 6.3.0 closes, and so completes, the upload even
+    when an exception is raised, which would land a truncated file the S3 event
+    handler ingests as complete. The upload is aborted with terminate() instead.
+    
+    Args:
+        url (str): S3 URI of the object to write
+        transport_params (dict): smart_open transport parameters
+            
+    Yields:
+        object: Binary file object
+    '''
+    
+    writer = smart_open.open(url, 'wb', transport_params=transport_params)
+    try:
+        yield writer
+    except BaseException:
+        logger.info(f'[LAMBDA LOG] - Aborting the upload of {url}')
+        writer.terminate()
+        raise
+    writer.close()
+
 # Write data to S3 using smart_open
-def write_to_s3_smart_v2(event, payload, file_name, s3_client, keys=[], update_dict = {}):
+def write_to_s3_smart_v2(event, payload, file_name, s3_client, keys=[], update_dict = {}, extrasaction='raise', as_records=False, pinned_schema=None):
     ''' Writes data to S3 via smart_open 
     
     To do:
@@ -220,6 +545,10 @@ def write_to_s3_smart_v2(event, payload, file_name, s3_client, keys=[], update_d
         file_name (str): Object name to be used when storing data in S3
         s3_client (client): A low-level client representing Amazon Simple Storage Service (S3)
         keys (dict): Returns the keys of the JSON payload to write the schema
+        extrasaction (str): 'ignore' drops record fields missing from keys instead of raising
+        as_records (bool): payload is an iterable of records whatever event['file_type'] is,
+            text payloads of XML, CSV_ZIP and json endpoints are otherwise written verbatim
+        pinned_schema (PinnedSchema): Schema shared by the Parquet files of the invocation
             
     Returns:
         None
@@ -230,28 +559,62 @@ def write_to_s3_smart_v2(event, payload, file_name, s3_client, keys=[], update_d
 
     url=f's3://{event["landing_bucket_path"]}/{file_name}'
 
-    with smart_open.open(url, 'w', transport_params={'client': s3_client}) as csvfile:
-        if event['file_type'] == 'XML' or event['file_type'] == 'CSV_ZIP' or event['file_type'] == 'json':
+    # smart_open holds one part in memory before uploading it, event['s3_part_size_mb'] bounds it
+    transport_params = {'client': s3_client, 'min_part_size': int(event.get('s3_part_size_mb', 16)) * 1024 * 1024}
+    
+    text_payload = not as_records and event['file_type'] in ('XML', 'CSV_ZIP', 'json')
+    
+    if event.get('output_format') == 'parquet' and not text_payload:
+        if file_name.endswith('.csv'):
+            file_name = file_name[:-len('.csv')] + '.parquet'
+        url = f's3://{event["landing_bucket_path"]}/{file_name}'
+        with open_s3_writer(url, transport_params) as parquetfile:
+            count_row = write_parquet(event, payload, parquetfile, keys, update_dict, extrasaction, pinned_schema)
+        logger.info(f'[LAMBDA LOG] - Finished writing {str(count_row)} records to {event["landing_bucket_path"]}/{file_name} in S3 as Parquet via smart_open')
+        return None
+    
+    with open_s3_writer(url, transport_params) as s3file:
+        if text_payload:
             logger.info(f'[LAMBDA LOG] - Writing file to {event["landing_bucket_path"]}/{file_name} in S3 via smart_open')
-            csvfile.write(payload)
+            s3file.write(payload.encode('utf-8'))
         else:
-            writer = csv.DictWriter(csvfile, fieldnames=keys, quoting=csv.QUOTE_ALL)
+            # Rows are encoded here, about 1 MB at a time, the writer is binary so a failed upload can be aborted
+            csvfile = io.StringIO()
+            writer = csv.DictWriter(csvfile, fieldnames=keys, quoting=csv.QUOTE_ALL, extrasaction=extrasaction)
             writer.writeheader()
             count_row = 0
+            # payload may be a generator of streamed records, which has no length
             for data in payload:
                 writer.writerow({**data, **update_dict})
                 count_row += 1
-            logger.info(f'[LAMBDA LOG] - Finished writing {len(payload)} / {str(count_row)} records to {event["landing_bucket_path"]}/{file_name} in S3 via smart_open')
+                if csvfile.tell() >= 1024 * 1024:
+                    s3file.write(csvfile.getvalue().encode('utf-8'))
+                    csvfile.seek(0)
+                    csvfile.truncate()
+            s3file.write(csvfile.getvalue().encode('utf-8'))
+            logger.info(f'[LAMBDA LOG] - Finished writing {str(count_row)} records to {event["landing_bucket_path"]}/{file_name} in S3 via smart_open')
 
     return None
 
 # Function to manage paginiation (next_url_method)
-def paginiation_url_daisy(event, session, url, s3_client, key_prefix):
+def paginiation_url_daisy(event, session, url, s3_client, key_prefix, run_key, pinned_schema=None):
     ''' Iterates over all next url tokens until all data is ingested or the 
         max count is reached
     
-    To do:
-        - 
+    The fetcher follows the next url while upload workers write the earlier
+    batches to S3, so downloads and uploads overlap. At most event['upload_workers']
+    (default 2) uploads run and event['upload_queue_size'] (default 2) fetched
+    batches wait for a worker, beyond that the fetcher blocks, which caps memory.
+    If a fetch or an upload fails, the parameters of the first batch that was not
+    written are returned so the next invocation resumes there. The next urls can
+    only be followed in order, so batches written after it are fetched again, each
+    batch file is named after the run key and the query parameters that fetched it
+    so the rewrite replaces the earlier file as long as event['run_key'] is the
+    same for every invocation of the run. The error is raised if no batch was written.
+    
+    The records of each response are read with the jmespath expression in
+    event['records_path'] (default filtered_data) and the next url with
+    event['next_url_path'] (default next_url).
     
     Args:
         event (dict): Payload from airflow which contains all information / 
@@ -260,6 +623,8 @@ def paginiation_url_daisy(event, session, url, s3_client, key_prefix):
         url (str): Endpoint to extract data from
         s3_client (client): A low-level client representing Amazon Simple Storage Service (S3)
         key_prefix (str): Prefix of all batches written to S3
+        run_key (str): Names the batches of one run apart from those of the other runs
+        pinned_schema (PinnedSchema): Schema shared by the Parquet files of the invocation
             
     Returns:
         updated_params (dict): The updated parameters for the next lambda invocation
@@ -269,60 +634,198 @@ def paginiation_url_daisy(event, session, url, s3_client, key_prefix):
     count = 0
     end_loop = False
     next_url_list = []
+    no_data = False
+    fetch_error = None
+    upload_workers = int(event.get('upload_workers', 2))
+    slots = threading.BoundedSemaphore(upload_workers + int(event.get('upload_queue_size', 2)))
+    # Parameters used to fetch each batch and the upload of each batch
+    batch_params = []
+    uploads = {}
+    
+    def upload(batch_id, filtered_data, file_name, keys):
+        try:
+            if event["s3_write_type"] == 'batch':
+                write_to_s3(payload=filtered_data, file_name=file_name + '.json', s3_client=s3_client, event=event)
+            elif event["s3_write_type"] == 'smart':
+                write_to_s3_smart_v2(event=event, payload=filtered_data, file_name=file_name + '.csv', s3_client=s3_client, keys=keys, as_records=True, pinned_schema=pinned_schema)
+            logger.info(f'[LAMBDA LOG] - Uploaded batch {batch_id} to: {event["landing_bucket"]}/{file_name}')
+        finally:
+            slots.release()
+    
+    with ThreadPoolExecutor(max_workers=upload_workers) as executor:
+        try:
+            # Loop over all endpoints while there is a next token
+            while end_loop == False and count < int(event['batch_upper_limit']):
+                
+                # Stop fetching once an upload failed, the batch has to be fetched again anyway
+                if any(future.done() and future.exception() for future in uploads.values()):
+                    break
+                
+                # Call send_request method to extract payload, failed requests raise instead of passing for an empty batch
+                event["batch_id"] = count
+                batch_params.append(event["query_params"])
+                payload = json.loads(send_request(session, url, event, strict=True))
+                
+                # Create file name based on the query parameters of the batch, a resumed invocation rewrites the same file
+                batch_hash = hashlib.sha1(json.dumps(event["query_params"], sort_keys=True, default=str).encode()).hexdigest()[:16]
+                file_name = f'{key_prefix}/batch_{run_key}_{batch_hash}'
+                logger.info(f'[LAMBDA LOG] - Recieved payload for batch, uploading to: {event["landing_bucket"]}/{file_name}')
+                
+                # Filter payload and define next_url
+                filtered_data = jmespath.search(event.get('records_path', 'filtered_data'), payload)
+                if filtered_data is None:
+                    raise Exception(f'Batch {count} of {url} has no records at {event.get("records_path", "filtered_data")}: {str(payload)[:1000]}')
+                if len(filtered_data) == 0:
+                    
+                    logger.info(f'[LAMBDA LOG] - No data to ingest')
+                    batch_params.pop()
+                    no_data = True
+                    break
+                    
+                next_url = jmespath.search(event.get('next_url_path', 'next_url'), payload)
+                next_url_list.append(next_url)
+                
+                if int(event["batch_id"]) == 0:
+                    keys=filtered_data[0].keys()
+                
+                # Blocks while the upload workers and the queue are busy
+                slots.acquire()
+                uploads[count] = executor.submit(upload, count, filtered_data, file_name, keys)
+                
+                # Update parameters to use the new token
+                updated_params = parse_qs(urlparse(next_url).query)
+                
+                # update event to use updated params
+                event["query_params"] = updated_params
+                
+                # Break loop if the URL is None, indicates all data is extracted
+                if next_url == None:
+                    end_loop = True
+                    logger.info('[LAMBDA LOG] - Finished extracting all data')
+                    break
+                
+                count += 1
+        except Exception as ex:
+            logger.error(f'[LAMBDA LOG] - Failed to fetch batch {count}: {ex}')
+            fetch_error = ex
+    
+    # The with block waited for all uploads, find the first batch that is not durably written
+    first_missing = next((batch_id for batch_id in range(len(batch_params))
+                          if batch_id not in uploads or uploads[batch_id].exception()), None)
+    if first_missing is not None:
+        error = fetch_error or next(uploads[batch_id].exception() for batch_id in sorted(uploads)
+                                    if uploads[batch_id].exception())
+        if first_missing == 0:
+            raise error
+        logger.error(f'[LAMBDA LOG] - Batch {first_missing} was not written due to {error}, resuming from its parameters')
+        return batch_params[first_missing]
     
-    # Loop over all endpoints while there is a next token
-    while end_loop == False and count < int(event['batch_upper_limit']):
-        
-        # Call send_request method to extract payload
-        event["batch_id"] = count
-        payload = send_request(session, url, event)
-        
-        # Create file name based on DAG_ID, Module etc
-        file_name = f'{key_prefix}/batch_{str(event["lambda_run_id"])}_{str(event["batch_id"])}'
-        logger.info(f'[LAMBDA LOG] - Recieved payload for batch and uploaded to: {event["landing_bucket"]}/{file_name}')
-        
-        # Filter payload and define next_url
-        filtered_data = payload['filtered_data']
-        if len(filtered_data) == 0:
-            
-            logger.info(f'[LAMBDA LOG] - No data to ingest')
-            return 'No data'
-            
-        next_url = payload['next_url']
-        next_url_list.append(next_url)
-
-        if event["s3_write_type"] == 'batch':
-            file_name = file_name + '.json'
-            write_to_s3(payload=filtered_data, file_name=file_name, s3_client=s3_client, event=event)
-
-        elif event["s3_write_type"] == 'smart':
-            if int(event["batch_id"]) == 0:
-                keys=filtered_data[0].keys()
-            file_name = file_name + '.csv'
-            write_to_s3_smart_v2(event=event, payload=filtered_data, file_name=file_name, s3_client=s3_client, keys=keys)
-        
-        # Update parameters to use the new token
-        updated_params = parse_qs(urlparse(next_url).query)
-        
-        # update event to use updated params
-        event["query_params"] = updated_params
-
-        # Break loop if the URL is None, indicates all data is extracted
-        if next_url == None:
-            end_loop = True
-            logger.info('[LAMBDA LOG] - Finished extracting all data')
-            break
-        
-        count += 1
-        
     logger.info(f'[LAMBDA LOG] - Next URLs used: {str(next_url_list)}'.replace(", ","\n - ").replace("[","\n - ").replace("]",""))
     
     # Determine what to return back to airflow
+    if no_data:
+        return 'No data'
     if next_url == None:
         return None
     else:
         return updated_params
 
+# Function to manage paginiation (page number / offset method)
+def pagination_paged(event, session, url, s3_client, key_prefix, run_key, pinned_schema=None):
+    ''' Reads the total from the first page, then fetches the remaining pages
+        concurrently and writes every page to S3 as soon as it arrives
+    
+    Pages are addressed by event['page_param'], which holds a page number when
+    event['page_style'] is 'page' (default) or a record offset when it is 'offset'.
+    The total is read from the first response with the jmespath expression in
+    event['total_path'], as a record count unless event['total_type'] is 'pages',
+    and the records of every page with event['records_path'] (default the whole
+    response). At most event['max_concurrency'] (default 8) requests are in flight
+    over the shared session, and at most event['batch_upper_limit'] pages are
+    fetched per invocation.
+    
+    Args:
+        event (dict): Payload from airflow which contains all information / 
+            configuration required to ingest data from the specified endpoint
+        session (object): Containing persistent request parameters
+        url (str): Endpoint to extract data from
+        s3_client (client): A low-level client representing Amazon Simple Storage Service (S3)
+        key_prefix (str): Prefix of all batches written to S3
+        run_key (str): Names the batches of one run apart from those of the other runs
+        pinned_schema (PinnedSchema): Schema shared by the Parquet files of the invocation
+            
+    Returns:
+        updated_params (dict): The updated parameters for the next lambda invocation,
+            None once all pages are extracted
+    '''
+    
+    page_param = event['page_param']
+    page_size = int(event['page_size'])
+    offset_style = event.get('page_style', 'page') == 'offset'
+    max_concurrency = int(event.get('max_concurrency', 8))
+    query_params = dict(event['query_params'] or {})
+    if event.get('page_size_param'):
+        query_params[event['page_size_param']] = page_size
+    # Page values are first_page + index for page numbers and first_page + index * page_size for offsets
+    first_page = int(event.get('first_page', 0 if offset_style else 1))
+    step = page_size if offset_style else 1
+    # Pages before the one in query_params were extracted by previous invocations
+    first_index = (int(query_params.get(page_param, first_page)) - first_page) // step
+    
+    # Requests pools one connection per host by default, size the pool for the concurrent requests
+    adapter = HTTPAdapter(pool_connections=max_concurrency, pool_maxsize=max_concurrency)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    
+    def fetch_and_write(page_value, keys=None):
+        # Every request gets its own copy of the event, threads share nothing but the session and client
+        page_event = {**event, 'query_params': {**query_params, page_param: page_value}, 'batch_id': page_value}
+        # Failed requests raise instead of passing for an empty page
+        response = json.loads(send_request(session, url, page_event, strict=True))
+        records = jmespath.search(event['records_path'], response) if event.get('records_path') else response
+        if records is None:
+            raise Exception(f'Page {page_value} of {url} has no records at {event.get("records_path")}: {str(response)[:1000]}')
+        file_name = f'{key_prefix}/batch_{run_key}_{str(event["lambda_run_id"])}_{str(page_value)}'
+        if records:
+            if event["s3_write_type"] == 'batch':
+                write_to_s3(payload=records, file_name=file_name + '.json', s3_client=s3_client, event=event)
+            elif event["s3_write_type"] == 'smart':
+                write_to_s3_smart_v2(event=event, payload=records, file_name=file_name + '.csv', s3_client=s3_client,
+                                     keys=keys or records[0].keys(), as_records=True, pinned_schema=pinned_schema)
+            logger.info(f'[LAMBDA LOG] - Recieved {len(records)} records for page {page_value} and uploaded to: {event["landing_bucket"]}/{file_name}')
+        return response, records
+    
+    first_response, first_records = fetch_and_write(first_page + first_index * step)
+    if not first_records:
+        logger.info(f'[LAMBDA LOG] - No data to ingest')
+        return 'No data'
+    
+    # A missing total would end the run after the first page, only an explicit 0 means there are no more pages
+    total = jmespath.search(event['total_path'], first_response)
+    if total is None:
+        raise Exception(f'The first page of {url} has no total at {event["total_path"]}: {str(first_response)[:1000]}')
+    total = int(total)
+    total_pages = total if event.get('total_type', 'records') == 'pages' else math.ceil(total / page_size)
+    last_index = min(total_pages, first_index + int(event['batch_upper_limit']))
+    page_values = [first_page + index * step for index in range(first_index + 1, last_index)]
+    logger.info(f'[LAMBDA LOG] - {total} records in {total_pages} pages, fetching {len(page_values)} more pages with {max_concurrency} concurrent requests')
+    
+    keys = first_records[0].keys()
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        futures = [executor.submit(fetch_and_write, page_value, keys) for page_value in page_values]
+        done, not_done = wait(futures, return_when=FIRST_EXCEPTION)
+        for future in not_done:
+            future.cancel()
+        for future in done:
+            if future.exception():
+                raise future.exception()
+    
+    # Determine what to return back to airflow
+    if last_index >= total_pages:
+        logger.info('[LAMBDA LOG] - Finished extracting all data')
+        return None
+    return {**query_params, page_param: first_page + last_index * step}
+
 def run(event, context):
     ''' Cooridinates tasks to manage the ingestion of data using various ingestion methods
     
@@ -343,6 +846,9 @@ def run(event, context):
     start_time = time.time()
     s3 = boto3.client('s3')
     
+    # Every Parquet file of the invocation, page or batch, is written with the same schema
+    pinned_schema = PinnedSchema()
+    
     # Perform an incremental load if configured
     if event['merge_pattern'] == 'incremental' and event['lambda_run_id'] == 0:
         logger.info(f'[LAMBDA LOG] - Performing incremental load')
@@ -383,8 +889,20 @@ def run(event, context):
     local_timestamp_str = local_time.strftime("%Y%m%d%H%M%S")
     
     generic_file_name = event['generic_file_name'] + '_' + local_timestamp_str
+    
+    # Prefix of the batch files written by the paginated approaches
+    key_prefix = event.get('key_prefix', event['generic_file_name'])
+    
+    # Part of every batch file name, so the files of a run do not overwrite those of the previous runs. Airflow can
+    # pass a value that is stable across the invocations of a DAG run, e.g. {{ ts_nodash }}
+    run_key = str(event.get('run_key') or local_timestamp_str)
 
-    if event['pagination'] == '_NA':
+    if event['pagination'] == '_NA' and event.get('stream'):
+        logger.info('[LAMBDA LOG] - Streaming a JSON endpoint to CSV')
+        file_name = generic_file_name + '.csv'
+        data = stream_json_to_s3(session=session, url=url, event=event, file_name=file_name, s3_client=s3, pinned_schema=pinned_schema)
+        
+    elif event['pagination'] == '_NA':
         payload = send_request(event=event, session=session, url=url)
         logger.info('[LAMBDA LOG] - Successfully made HTTP request for full load')
         if event['file_type'] == 'xml':
@@ -408,7 +926,11 @@ def run(event, context):
         
     elif event['pagination'] == 'Daisy':
         logger.info('[LAMBDA LOG] - Performing pagination approach: \'Daisy\'')
-        data = paginiation_url_daisy(event=event, session=session, url=url, s3_client=s3, key_prefix=key_prefix)
+        data = paginiation_url_daisy(event=event, session=session, url=url, s3_client=s3, key_prefix=key_prefix, run_key=run_key, pinned_schema=pinned_schema)
+        
+    elif event['pagination'] == 'Paged':
+        logger.info('[LAMBDA LOG] - Performing pagination approach: \'Paged\'')
+        data = pagination_paged(event=event, session=session, url=url, s3_client=s3, key_prefix=key_prefix, run_key=run_key, pinned_schema=pinned_schema)
         
     else: 
         logger.info('[LAMBDA LOG] - Unknown pagination type')
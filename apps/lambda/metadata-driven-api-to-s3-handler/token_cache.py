@@ -0,0 +1,114 @@
+import json
+import logging
+import os
+import threading
+import time
+
+from requests.auth import AuthBase
+
+logger = logging.getLogger()
+
+
+class TokenCache:
+    # Process wide cache of bearer tokens keyed on (secret id, auth method), so warm invocations and the Daisy
+    # continuations of a DAG run reuse the token instead of repeating the exchange. A token is replaced refresh_margin
+    # seconds before it expires according to the expires_in of the token response, default_ttl when there is none.
+    # With ssm_prefix set, tokens are also shared with the other execution environments through SecureString
+    # parameters named <ssm_prefix>/<secret id>/<auth method>. The shared store is best effort, its failures fall
+    # back to a token exchange.
+
+    def __init__(self, refresh_margin=60, default_ttl=900, ssm_prefix=None, kms_key_id=None):
+        self._refresh_margin = refresh_margin
+        self._default_ttl = default_ttl
+        self._ssm_prefix = ssm_prefix.rstrip("/") if ssm_prefix else None
+        self._kms_key_id = kms_key_id
+        self._ssm = None
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.exchanges = 0
+        self.hits = 0
+
+    def _fresh(self, entry, rejected_token):
+        # wall clock time, expiries are compared across execution environments
+        return entry and entry["access_token"] != rejected_token and \
+            entry["expires_at"] - self._refresh_margin > time.time()
+
+    def _parameter_name(self, key):
+        return f"{self._ssm_prefix}/{'/'.join(str(part).strip('/') for part in key)}"
+
+    def _load_shared(self, key):
+        if not self._ssm_prefix:
+            return None
+        try:
+            if self._ssm is None:
+                import boto3
+                self._ssm = boto3.client("ssm")
+            parameter = self._ssm.get_parameter(Name=self._parameter_name(key), WithDecryption=True)
+            return json.loads(parameter["Parameter"]["Value"])
+        except Exception as ex:
+            if "ParameterNotFound" not in type(ex).__name__ + str(ex):
+                logger.warning(f"[LAMBDA LOG] - Could not read the shared token of {key[0]}: {ex}")
+            return None
+
+    def _store_shared(self, key, entry):
+        if not self._ssm_prefix:
+            return
+        try:
+            extra_args = {"KeyId": self._kms_key_id} if self._kms_key_id else {}
+            self._ssm.put_parameter(Name=self._parameter_name(key), Value=json.dumps(entry), Type="SecureString",
+                                    Overwrite=True, **extra_args)
+        except Exception as ex:
+            logger.warning(f"[LAMBDA LOG] - Could not share the token of {key[0]}: {ex}")
+
+    def get(self, key, exchange, rejected_token=None):
+        # exchange() performs the token exchange and returns (access token, expires_in seconds or None). A caller
+        # whose token was rejected passes it as rejected_token, it is only replaced if nobody replaced it yet.
+        with self._lock:
+            entry = self._entries.get(key)
+            if self._fresh(entry, rejected_token):
+                self.hits += 1
+                return entry["access_token"]
+            entry = self._load_shared(key)
+            if self._fresh(entry, rejected_token):
+                self.hits += 1
+                self._entries[key] = entry
+                return entry["access_token"]
+            access_token, expires_in = exchange()
+            self.exchanges += 1
+            entry = {"access_token": access_token,
+                     "expires_at": time.time() + float(expires_in or self._default_ttl)}
+            self._entries[key] = entry
+            self._store_shared(key, entry)
+            logger.info(f"[LAMBDA LOG] - Exchanged a token for {key[0]} ({key[1]}), valid for "
+                        f"{int(entry['expires_at'] - time.time())} seconds")
+            return access_token
+
+    def invalidate(self, key=None):
+        with self._lock:
+            for cached_key in [cached_key for cached_key in self._entries if key is None or cached_key == key]:
+                del self._entries[cached_key]
+
+
+class BearerTokenAuth(AuthBase):
+    # Sets the cached bearer token on every request of a session, so a long running pagination picks up the proactive
+    # refresh. refresh() replaces a token the API rejected with a 401.
+
+    def __init__(self, cache, key, exchange):
+        self._cache = cache
+        self._key = key
+        self._exchange = exchange
+        self.token = None
+
+    def __call__(self, request):
+        self.token = self._cache.get(self._key, self._exchange)
+        request.headers["Authorization"] = f"Bearer {self.token}"
+        return request
+
+    def refresh(self):
+        self.token = self._cache.get(self._key, self._exchange, rejected_token=self.token)
+
+
+token_cache = TokenCache(refresh_margin=float(os.environ.get("TOKEN_CACHE_REFRESH_MARGIN_SECONDS", 60)),
+                         default_ttl=float(os.environ.get("TOKEN_CACHE_DEFAULT_TTL_SECONDS", 900)),
+                         ssm_prefix=os.environ.get("TOKEN_CACHE_SSM_PREFIX"),
+                         kms_key_id=os.environ.get("TOKEN_CACHE_KMS_KEY_ID"))
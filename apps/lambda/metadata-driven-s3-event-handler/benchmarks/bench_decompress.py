@@ -0,0 +1,93 @@
+# Compares peak RSS and throughput of the buffered and streaming gzip paths of DecompressArchive.
+#
+#   python benchmarks/bench_decompress.py --size-mb 512 --latency-ms 20
+#
+# Every path runs in its own interpreter so ru_maxrss is not shared between them. The archive is served by the
+# disk backed FakeS3, so the numbers only reflect what the code under test keeps in memory.
+import argparse
+import gzip
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+from io import BytesIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fakes import FakeS3
+from transfer import MB
+from transfer import MultipartStreamWriter
+from transfer import iter_gunzip
+
+
+def make_archive(s3, size_mb):
+    # random csv rows compress roughly 3:1, repeating a 4 MB block is invisible to gzip's 32 KB window
+    block = b"".join(f"2023-01-01T00:00:00,{os.urandom(8).hex()},{os.urandom(12).hex()},{i % 977}\n".encode()
+                     for i in range(4 * MB // 80))[:4 * MB]
+    with open(os.path.join(s3._path("landing", "src/data.csv.gz")), "wb") as target:
+        with gzip.GzipFile(fileobj=target, mode="wb", compresslevel=6) as archive:
+            for _ in range(size_mb // 4):
+                archive.write(block)
+
+
+def buffered(s3, args):
+    # the pre-streaming implementation: whole archive in a BytesIO, then GzipFile into upload_fileobj
+    s3.upload_fileobj(Fileobj=gzip.GzipFile(None, "rb", fileobj=BytesIO(
+                          s3.get_object(Bucket="landing", Key="src/data.csv.gz")["Body"].read())),
+                      Bucket="target", Key="src/data.csv")
+
+
+def streaming(s3, args):
+    body = s3.get_object(Bucket="landing", Key="src/data.csv.gz")["Body"]
+    with MultipartStreamWriter(s3, bucket="target", key="src/data.csv", part_size=args.part_size_mb * MB,
+                               max_concurrency=args.max_concurrency) as writer:
+        for block in iter_gunzip(body.iter_chunks(MB)):
+            writer.write(block)
+
+
+def run_path(args):
+    s3 = FakeS3(latency=args.latency_ms / 1000.0, root=args.root)
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    started = time.monotonic()
+    {"buffered": buffered, "streaming": streaming}[args.path](s3, args)
+    elapsed = time.monotonic() - started
+    output_mb = os.path.getsize(os.path.join(args.root, "target", "src/data.csv")) / MB
+    print(json.dumps({"path": args.path,
+                      "seconds": round(elapsed, 3),
+                      "throughput_mb_s": round(output_mb / elapsed, 1),
+                      "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+                      "rss_growth_mb": round((resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline) / 1024, 1),
+                      "s3_calls": s3.calls}))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size-mb", type=int, default=256, help="decompressed size of the archive")
+    parser.add_argument("--latency-ms", type=float, default=0, help="latency injected on every fake S3 call")
+    parser.add_argument("--part-size-mb", type=int, default=8)
+    parser.add_argument("--max-concurrency", type=int, default=4)
+    parser.add_argument("--path", choices=["buffered", "streaming"])
+    parser.add_argument("--root")
+    args = parser.parse_args()
+    if args.path:
+        return run_path(args)
+
+    s3 = FakeS3()
+    try:
+        make_archive(s3, args.size_mb)
+        print(f"archive: {os.path.getsize(s3._path('landing', 'src/data.csv.gz')) / MB:.1f} MB compressed, "
+              f"{args.size_mb} MB decompressed")
+        for path in ("buffered", "streaming"):
+            subprocess.run([sys.executable, __file__, "--path", path, "--root", s3._root,
+                            "--size-mb", str(args.size_mb), "--latency-ms", str(args.latency_ms),
+                            "--part-size-mb", str(args.part_size_mb), "--max-concurrency", str(args.max_concurrency)],
+                           check=True)
+    finally:
+        s3.cleanup()
+
+
+if __name__ == "__main__":
+    main()
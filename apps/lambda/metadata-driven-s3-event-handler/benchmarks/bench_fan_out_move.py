@@ -0,0 +1,90 @@
+# Times the landing move (archive copy + target copy + delete) with the sequential managed copies used before and
+# with transfer.fan_out_move.
+#
+#   python benchmarks/bench_fan_out_move.py --bucket my-scratch-bucket --sizes-mb 1 1024 10240
+#
+# With --bucket the run goes against real S3 (boto3 and credentials required). Source objects above 64 MB are
+# assembled server side with upload_part_copy, so a 10 GB object is never uploaded from the client. Without
+# --bucket the disk backed FakeS3 is used with --latency-ms per call, which only shows the request pattern.
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from transfer import MB
+from transfer import fan_out_move
+
+SEED_KEY = "bench/seed-64mb"
+
+
+def make_source(s3, bucket, key, size):
+    if size <= 64 * MB:
+        s3.put_object(Bucket=bucket, Key=key, Body=os.urandom(size))
+        return
+    s3.put_object(Bucket=bucket, Key=SEED_KEY, Body=os.urandom(64 * MB))
+    upload_id = s3.create_multipart_upload(Bucket=bucket, Key=key)["UploadId"]
+    parts = []
+    for number, start in enumerate(range(0, size, 64 * MB), start=1):
+        length = min(64 * MB, size - start)
+        response = s3.upload_part_copy(Bucket=bucket, Key=key, UploadId=upload_id, PartNumber=number,
+                                       CopySource={"Bucket": bucket, "Key": SEED_KEY},
+                                       CopySourceRange=f"bytes=0-{length - 1}")
+        parts.append({"PartNumber": number, "ETag": response["CopyPartResult"]["ETag"]})
+    s3.complete_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id, MultipartUpload={"Parts": parts})
+
+
+def sequential_move(s3, bucket, key, destinations, args):
+    # the implementation before fan_out_move: one managed copy after the other, then the delete
+    for target_bucket, target_key in destinations:
+        s3.copy({"Bucket": bucket, "Key": key}, target_bucket, target_key)
+    s3.delete_object(Bucket=bucket, Key=key)
+
+
+def parallel_move(s3, bucket, key, destinations, args):
+    fan_out_move(s3, bucket, key, destinations, multipart_threshold=args.threshold_mb * MB,
+                 part_size=args.part_size_mb * MB, max_concurrency=args.max_concurrency)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--bucket", help="scratch bucket for a run against real S3")
+    parser.add_argument("--sizes-mb", type=int, nargs="+", default=[1, 64, 256])
+    parser.add_argument("--latency-ms", type=float, default=20, help="latency per call of the fake S3")
+    parser.add_argument("--threshold-mb", type=int, default=64)
+    parser.add_argument("--part-size-mb", type=int, default=64)
+    parser.add_argument("--max-concurrency", type=int, default=10)
+    args = parser.parse_args()
+
+    if args.bucket:
+        import boto3
+        s3, bucket = boto3.client("s3"), args.bucket
+    else:
+        from fakes import FakeS3
+        s3, bucket = FakeS3(latency=args.latency_ms / 1000.0), "bench"
+
+    print(f"{'size':>10} {'sequential s':>14} {'fan out s':>11} {'speedup':>8}")
+    try:
+        for size_mb in args.sizes_mb:
+            timings = []
+            for move in (sequential_move, parallel_move):
+                key = f"bench/landing/{size_mb}mb.csv"
+                make_source(s3, bucket, key, size_mb * MB)
+                destinations = [(bucket, f"bench/archives/{size_mb}mb.csv"), (bucket, f"bench/ingestion/{size_mb}mb.csv")]
+                started = time.monotonic()
+                move(s3, bucket, key, destinations, args)
+                timings.append(time.monotonic() - started)
+                for target_bucket, target_key in destinations:
+                    s3.delete_object(Bucket=target_bucket, Key=target_key)
+            print(f"{size_mb:>8}MB {timings[0]:>14.2f} {timings[1]:>11.2f} {timings[0] / timings[1]:>7.1f}x")
+    finally:
+        if args.bucket:
+            s3.delete_object(Bucket=bucket, Key=SEED_KEY)
+        else:
+            s3.cleanup()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+# Import time report of the handler, the equivalent of reading `python -X importtime -c "import lambda_runner"` by
+# hand. Every run is a fresh interpreter, so the numbers are those of a cold start.
+#
+#   python benchmarks/bench_import_time.py --runs 5 --top 15
+#   python benchmarks/bench_import_time.py --max-ms 150
+#
+# The run fails when a module listed in --lazy is loaded by the import or by handling an event that only carries
+# ignored records (folder markers and archives/ keys), or when the median import time is above --max-ms.
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+HANDLER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+IGNORED_EVENT = ('{"Records": [{"eventSource": "aws:s3", "eventName": "ObjectCreated:Put", '
+                 '"s3": {"bucket": {"name": "landing"}, "object": {"key": "archives/file.csv"}}}, '
+                 '{"eventSource": "aws:s3", "eventName": "ObjectCreated:Put", '
+                 '"s3": {"bucket": {"name": "landing"}, "object": {"key": "folder/"}}}]}')
+
+LOADED_MODULES = "import sys; print(','.join(sorted(sys.modules)))"
+
+
+def import_times(code):
+    # returns {module: (self us, cumulative us)} as reported by -X importtime
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code], cwd=HANDLER_DIR,
+                            capture_output=True, text=True, check=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        times[name.strip()] = (int(self_us), int(cumulative_us))
+    return times
+
+
+def loaded_modules(code):
+    result = subprocess.run([sys.executable, "-c", f"{code}\n{LOADED_MODULES}"], cwd=HANDLER_DIR,
+                            capture_output=True, text=True, check=True)
+    return set(result.stdout.strip().splitlines()[-1].split(","))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--module", default="lambda_runner")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=10)
+    parser.add_argument("--max-ms", type=float, help="fail when the median import time is above this")
+    parser.add_argument("--lazy", default="snowflake.connector,boto3,botocore,zipfile",
+                        help="modules that must not be loaded by the import or by an ignored event")
+    args = parser.parse_args()
+
+    # modules the interpreter loads before any handler code runs (site, .pth hooks) are not attributed to the handler
+    interpreter = import_times("pass")
+    runs = [import_times(f"import {args.module}") for _ in range(args.runs)]
+    total_ms = statistics.median(run[args.module][1] for run in runs) / 1000
+    print(f"{args.module}: median import time {total_ms:.1f} ms over {args.runs} runs")
+    heaviest = sorted(((name, times) for name, times in runs[-1].items() if name not in interpreter),
+                      key=lambda item: item[1][1], reverse=True)[:args.top]
+    print(f"{'cumulative ms':>14} {'self ms':>9}  module")
+    for name, (self_us, cumulative_us) in heaviest:
+        print(f"{cumulative_us / 1000:>14.1f} {self_us / 1000:>9.1f}  {name}")
+
+    failures = []
+    lazy = [name for name in args.lazy.split(",") if name and name not in loaded_modules("pass")]
+    on_import = loaded_modules(f"import {args.module}")
+    on_ignored_event = loaded_modules(f"import json, {args.module}; {args.module}.run(json.loads('{IGNORED_EVENT}'), None)")
+    for stage, modules in (("import", on_import), ("ignored event", on_ignored_event)):
+        eager = [name for name in lazy if name in modules]
+        print(f"loaded on {stage}: {', '.join(eager) if eager else 'none of ' + ', '.join(lazy)}")
+        if eager:
+            failures.append(f"{', '.join(eager)} loaded on {stage}")
+    if args.max_ms is not None and total_ms > args.max_ms:
+        failures.append(f"median import time {total_ms:.1f} ms is above {args.max_ms} ms")
+    if failures:
+        print(f"FAILED: {'; '.join(failures)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+# Drives synthetic S3 notification batches through lambda_runner.run against local stand-ins and reports records per
+# second, per record latency percentiles and peak RSS.
+#
+#   python benchmarks/bench_throughput.py --batches 20 --batch-size 50 --file-kb 64 \
+#       --rules regex,size,duplication,glue --workers 8 --s3-latency-ms 20 --snowflake-latency-ms 40
+#
+# S3 and Glue are served by FakeS3 and FakeGlue through clients.set_client, Snowflake by the SQLite backed
+# FakeSnowflake which replaces snowflake.connector. --invalid-ratio makes that share of the files fail the name
+# check so the rejection path is measured too. Options such as the dedupe index or the metadata cache TTL are passed
+# through --context-variables as a JSON object, the same way the Lambda receives them.
+import argparse
+import contextlib
+import gzip
+import json
+import logging
+import os
+import random
+import resource
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fakes import FakeGlue
+from fakes import FakeS3
+from fakes import FakeSnowflake
+
+RULES = {"regex": 's3.file_name_regex_check{"file_name_pattern": "data_.*\\\\.(csv|gz)"}',
+         "size": 's3.file_size_check',
+         "duplication": 's3.duplication_check{"check_window": {"days": 1}}',
+         "decompress": 's3.decompress_archive{"target_path": "ingestion/decompressed"}',
+         "glue": 'glue.call_job{"job_name": "bench-ingestion-job"}',
+         "glue_batch": 'glue.call_job{"job_name": "bench-ingestion-job", "batch_max_files": 25, '
+                       '"batch_window_seconds": 0.5, "backoff_seconds": 0.2}'}
+
+SCHEMA = ("CREATE TABLE INGESTION_METADATA (SOURCE_NAME TEXT, GENERIC_FILE_NAME TEXT, LANDING_BUCKET_PATH TEXT, "
+          "INGESTION_BUCKET_PATH TEXT, REJECTION_BUCKET_PATH TEXT, FILE_TYPE TEXT, ON_LANDING TEXT, UPDATED_AT TEXT)",
+          "CREATE TABLE EVENT_LOGS (SOURCE_NAME TEXT, GENERIC_FILE_NAME TEXT, BUCKET_NAME TEXT, FILE_PATH TEXT, "
+          "FILE_NAME TEXT, FILE_TIMESTAMP TEXT, COMPONENT_NAME TEXT, ACTION TEXT, ACTION_STATUS TEXT, "
+          "ACTION_TIMESTAMP TEXT)",
+          "CREATE TABLE FILE_DEDUPE_INDEX (FILE_KEY TEXT, ETAG TEXT, LANDED_AT TEXT)")
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def make_body(size, compressed):
+    rows = b"".join(f"{i},{os.urandom(6).hex()},{random.random():.6f}\n".encode() for i in range(size // 28 + 1))
+    return gzip.compress(rows[:size]) if compressed else rows[:size]
+
+
+def notification(key, size):
+    return {"eventSource": "aws:s3", "eventName": "ObjectCreated:Put",
+            "s3": {"configurationId": "bench-landing", "bucket": {"name": "landing"},
+                   "object": {"key": key, "size": size, "eTag": os.urandom(8).hex()}}}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batches", type=int, default=10)
+    parser.add_argument("--batch-size", type=int, default=20, help="records per notification")
+    parser.add_argument("--file-kb", type=int, default=64)
+    parser.add_argument("--rules", default="regex,size,duplication,glue", help=f"mix of {', '.join(RULES)}")
+    parser.add_argument("--sources", type=int, default=4, help="distinct landing prefixes, one metadata row each")
+    parser.add_argument("--invalid-ratio", type=float, default=0.1)
+    parser.add_argument("--workers", type=int, default=1, help="RECORD_PROCESSING_WORKERS")
+    parser.add_argument("--s3-latency-ms", type=float, default=10)
+    parser.add_argument("--glue-latency-ms", type=float, default=50)
+    parser.add_argument("--glue-throttle-ratio", type=float, default=0.0)
+    parser.add_argument("--snowflake-latency-ms", type=float, default=30)
+    parser.add_argument("--snowflake-connect-ms", type=float, default=500)
+    parser.add_argument("--context-variables", default="{}", help="JSON merged into the context variables")
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    rules = [RULES[name] for name in args.rules.split(",") if name]
+    compressed = "decompress" in args.rules
+    s3 = FakeS3(latency=args.s3_latency_ms / 1000)
+    glue = FakeGlue(latency=args.glue_latency_ms / 1000, throttle_ratio=args.glue_throttle_ratio)
+    snowflake = FakeSnowflake(latency=args.snowflake_latency_ms / 1000,
+                              connect_latency=args.snowflake_connect_ms / 1000).install()
+    for statement in SCHEMA:
+        snowflake.db.execute(statement)
+    for source in range(args.sources):
+        snowflake.db.execute("INSERT INTO INGESTION_METADATA VALUES (?, ?, ?, ?, ?, ?, ?, '1')",
+                             (f"source_{source}", f"generic_{source}", f"landing/source_{source}",
+                              f"ingestion/source_{source}", f"rejection/source_{source}",
+                              "gz" if compressed else "csv", json.dumps(rules)))
+    snowflake.db.commit()
+
+    os.environ["events_mappings"] = json.dumps({"bench-landing": "landing"})
+    os.environ["context_variables"] = json.dumps({"SNOWFLAKE_SECRET_ARN": "bench",
+                                                  "SNOWFLAKE_METADATA_DATABASE": "BENCH",
+                                                  "SNOWFLAKE_METADATA_SCHEMA": "MTD",
+                                                  "SNOWFLAKE_METADATA_TABLE": "INGESTION_METADATA",
+                                                  "SNOWFLAKE_EVENT_LOG_TABLE": "EVENT_LOGS",
+                                                  "RECORD_PROCESSING_WORKERS": args.workers,
+                                                  **json.loads(args.context_variables)})
+
+    import clients
+    import lambda_runner
+    clients.set_client("s3", s3)
+    clients.set_client("glue", glue)
+    lambda_runner.get_secrets = lambda secret_arn, refresh=False: {"user": "bench", "password": "bench"}
+    logging.getLogger().setLevel(logging.CRITICAL)
+
+    latencies = []
+    process_record = lambda_runner.process_record
+
+    def timed_process_record(record, **kwargs):
+        started = time.monotonic()
+        try:
+            return process_record(record, **kwargs)
+        finally:
+            latencies.append(time.monotonic() - started)
+
+    lambda_runner.process_record = timed_process_record
+
+    file_size = args.file_kb * 1024
+    statuses = {}
+    elapsed = 0.0
+    try:
+        for batch in range(args.batches):
+            records = []
+            for index in range(args.batch_size):
+                prefix = "data" if random.random() >= args.invalid_ratio else "unexpected"
+                key = f"source_{index % args.sources}/{prefix}_{batch:04d}_{index:04d}.{'gz' if compressed else 'csv'}"
+                body = make_body(file_size, compressed)
+                s3.seed("landing", key, body)
+                records.append(notification(key, len(body)))
+            started = time.monotonic()
+            # metric lines and the tracebacks of rejected files are not part of the report
+            with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull), \
+                    contextlib.redirect_stderr(devnull):
+                result = lambda_runner.run({"Records": records}, None)
+            elapsed += time.monotonic() - started
+            for outcome in result["records"]:
+                statuses[outcome["status"]] = statuses.get(outcome["status"], 0) + 1
+    finally:
+        s3.cleanup()
+
+    total = args.batches * args.batch_size
+    print(f"records: {total} in {args.batches} batches of {args.batch_size}, {args.file_kb} KB files, "
+          f"rules {args.rules}, {args.workers} workers")
+    print(f"outcomes: {', '.join(f'{status} {count}' for status, count in sorted(statuses.items()))}")
+    print(f"throughput: {total / elapsed:.1f} records/s ({elapsed:.2f} s in run)")
+    print(f"record latency ms: p50 {percentile(latencies, 50) * 1000:.1f}, p90 {percentile(latencies, 90) * 1000:.1f}, "
+          f"p99 {percentile(latencies, 99) * 1000:.1f}, max {max(latencies) * 1000:.1f}, "
+          f"mean {statistics.mean(latencies) * 1000:.1f}")
+    print(f"peak RSS: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MB")
+    print(f"snowflake: {snowflake.connects} connects, {snowflake.statements} statements; "
+          f"s3 calls: {sum(s3.calls.values())}; glue runs: {len(glue.runs)}, throttled: {glue.throttled}")
+
+
+if __name__ == "__main__":
+    main()
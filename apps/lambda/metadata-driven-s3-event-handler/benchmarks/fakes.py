@@ -0,0 +1,294 @@
+import os
+import random
+import re
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import types
+import uuid
+
+
+class FakeBody:
+    # Mimics botocore's StreamingBody on top of a local file
+
+    def __init__(self, path, start=0, length=None):
+        self._file = open(path, "rb")
+        self._file.seek(start)
+        self._remaining = length if length is not None else os.path.getsize(path) - start
+
+    def read(self, amt=None):
+        if not self._remaining:
+            return b""
+        amt = self._remaining if amt is None else min(amt, self._remaining)
+        data = self._file.read(amt)
+        self._remaining -= len(data)
+        if not self._remaining:
+            self._file.close()
+        return data
+
+    def iter_chunks(self, chunk_size=1024 * 1024):
+        while True:
+            data = self.read(chunk_size)
+            if not data:
+                break
+            yield data
+
+
+class FakeS3:
+    # Disk backed stand-in for the subset of the S3 client API used by the handler, objects live under a temporary
+    # directory so the benchmark process memory only reflects what the code under test holds. Every API call
+    # sleeps for latency seconds to emulate the round trip.
+
+    def __init__(self, latency=0.0, root=None):
+        self._root = root or tempfile.mkdtemp(prefix="fake-s3-")
+        self._latency = latency
+        self._uploads = {}
+        self._lock = threading.Lock()
+        self.calls = {}
+
+    def cleanup(self):
+        shutil.rmtree(self._root, ignore_errors=True)
+
+    def _call(self, name):
+        with self._lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+        if self._latency:
+            time.sleep(self._latency)
+
+    def _path(self, bucket, key):
+        path = os.path.join(self._root, bucket, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+
+    def _write(self, bucket, key, body):
+        path = self._path(bucket, key)
+        with open(path, "wb") as target:
+            if isinstance(body, (bytes, bytearray)):
+                target.write(body)
+            else:
+                shutil.copyfileobj(body, target, 1024 * 1024)
+
+    def seed(self, bucket, key, body):
+        # test setup, neither counted nor delayed
+        self._write(bucket, key, body)
+
+    def exists(self, bucket, key):
+        return os.path.exists(os.path.join(self._root, bucket, key))
+
+    def keys(self, bucket):
+        base = os.path.join(self._root, bucket)
+        return sorted(os.path.relpath(os.path.join(folder, name), base)
+                      for folder, _, names in os.walk(base) for name in names)
+
+    def put_object(self, Bucket, Key, Body=b"", **kwargs):
+        self._call("put_object")
+        self._write(Bucket, Key, Body)
+        return {"ETag": f'"{uuid.uuid4().hex}"'}
+
+    def upload_fileobj(self, Fileobj, Bucket, Key, **kwargs):
+        # s3transfer reads a non seekable stream in 8 MB chunks and uploads up to 10 of them concurrently
+        from transfer import MultipartStreamWriter
+        with MultipartStreamWriter(self, Bucket, Key, part_size=8 * 1024 * 1024, max_concurrency=10) as writer:
+            for data in iter(lambda: Fileobj.read(8 * 1024 * 1024), b""):
+                writer.write(data)
+
+    def head_object(self, Bucket, Key, **kwargs):
+        self._call("head_object")
+        return {"ContentLength": os.path.getsize(os.path.join(self._root, Bucket, Key)), "Metadata": {}}
+
+    def get_object(self, Bucket, Key, Range=None, **kwargs):
+        self._call("get_object")
+        path = os.path.join(self._root, Bucket, Key)
+        size = os.path.getsize(path)
+        if not Range:
+            return {"Body": FakeBody(path), "ContentLength": size}
+        start, end = Range[len("bytes="):].split("-")
+        if not start:
+            start, end = max(size - int(end), 0), size - 1
+        start, end = int(start), min(int(end) if end else size - 1, size - 1)
+        return {"Body": FakeBody(path, start, end - start + 1), "ContentLength": end - start + 1}
+
+    def delete_object(self, Bucket, Key, **kwargs):
+        self._call("delete_object")
+        os.remove(os.path.join(self._root, Bucket, Key))
+
+    def copy_object(self, Bucket, Key, CopySource, **kwargs):
+        self._call("copy_object")
+        shutil.copyfile(os.path.join(self._root, CopySource["Bucket"], CopySource["Key"]), self._path(Bucket, Key))
+        return {"CopyObjectResult": {"ETag": f'"{uuid.uuid4().hex}"'}}
+
+    def copy(self, CopySource, Bucket, Key, **kwargs):
+        self.copy_object(Bucket=Bucket, Key=Key, CopySource=CopySource)
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        self._call("create_multipart_upload")
+        upload_id = uuid.uuid4().hex
+        with self._lock:
+            self._uploads[upload_id] = {}
+        return {"UploadId": upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        self._call("upload_part")
+        path = os.path.join(self._root, ".uploads", UploadId, str(PartNumber))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as target:
+            target.write(Body)
+        with self._lock:
+            self._uploads[UploadId][PartNumber] = path
+        return {"ETag": f'"{PartNumber}"'}
+
+    def upload_part_copy(self, Bucket, Key, UploadId, PartNumber, CopySource, CopySourceRange=None, **kwargs):
+        self._call("upload_part_copy")
+        source = os.path.join(self._root, CopySource["Bucket"], CopySource["Key"])
+        start, end = (int(x) for x in CopySourceRange[len("bytes="):].split("-"))
+        path = os.path.join(self._root, ".uploads", UploadId, str(PartNumber))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(source, "rb") as src, open(path, "wb") as target:
+            src.seek(start)
+            remaining = end - start + 1
+            while remaining:
+                data = src.read(min(remaining, 1024 * 1024))
+                target.write(data)
+                remaining -= len(data)
+        with self._lock:
+            self._uploads[UploadId][PartNumber] = path
+        return {"CopyPartResult": {"ETag": f'"{PartNumber}"'}}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        self._call("complete_multipart_upload")
+        with self._lock:
+            parts = self._uploads.pop(UploadId)
+        with open(self._path(Bucket, Key), "wb") as target:
+            for part in MultipartUpload["Parts"]:
+                with open(parts[part["PartNumber"]], "rb") as src:
+                    shutil.copyfileobj(src, target, 1024 * 1024)
+        shutil.rmtree(os.path.join(self._root, ".uploads", UploadId), ignore_errors=True)
+        return {}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self._call("abort_multipart_upload")
+        with self._lock:
+            self._uploads.pop(UploadId, None)
+        shutil.rmtree(os.path.join(self._root, ".uploads", UploadId), ignore_errors=True)
+
+
+class FakeGlueError(Exception):
+    # carries the same response shape as botocore's ClientError
+
+    def __init__(self, code):
+        super().__init__(code)
+        self.response = {"Error": {"Code": code}}
+
+
+class FakeGlue:
+    # throttle_ratio is the share of start_job_run calls rejected with ConcurrentRunsExceededException
+
+    def __init__(self, latency=0.0, throttle_ratio=0.0):
+        self._latency = latency
+        self._throttle_ratio = throttle_ratio
+        self._lock = threading.Lock()
+        self.runs = []
+        self.throttled = 0
+
+    def start_job_run(self, JobName, Arguments=None, **kwargs):
+        if self._latency:
+            time.sleep(self._latency)
+        with self._lock:
+            if self._throttle_ratio and random.random() < self._throttle_ratio:
+                self.throttled += 1
+                raise FakeGlueError("ConcurrentRunsExceededException")
+            self.runs.append((JobName, Arguments))
+            return {"JobRunId": f"jr_{len(self.runs):08d}"}
+
+
+class FakeSnowflakeCursor:
+    # Runs the statement against SQLite: bind variables become ?, database and schema qualifiers are dropped.
+    # Rows are fetched while the connection lock is held, so threads sharing the connection do not interleave.
+
+    def __init__(self, connection, dict_rows=False):
+        self._connection = connection
+        self._dict_rows = dict_rows
+        self._rows = []
+
+    @staticmethod
+    def _translate(query):
+        return re.sub(r"\b\w+\.\w+\.(\w+)", r"\1", query).replace("%s", "?")
+
+    def execute(self, query, params=None):
+        self._run(lambda db: db.execute(self._translate(query), tuple(params or ())))
+        return self
+
+    def executemany(self, query, rows):
+        self._run(lambda db: db.executemany(self._translate(query), rows))
+        return self
+
+    def _run(self, statement):
+        fake = self._connection.fake
+        if fake.latency:
+            time.sleep(fake.latency)
+        with fake.lock, fake.db:
+            cursor = statement(fake.db)
+            rows = cursor.fetchall()
+            columns = [column[0] for column in cursor.description or ()]
+        self._rows = [dict(zip(columns, row)) for row in rows] if self._dict_rows else rows
+        fake.statements += 1
+
+    def fetchall(self):
+        rows, self._rows = self._rows, []
+        return rows
+
+    def fetchone(self):
+        return self._rows.pop(0) if self._rows else None
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+
+class FakeSnowflakeConnection:
+
+    def __init__(self, fake):
+        self.fake = fake
+        self._closed = False
+
+    def cursor(self, cursor_class=None):
+        return FakeSnowflakeCursor(self, dict_rows=cursor_class is self.fake.module.DictCursor)
+
+    def is_closed(self):
+        return self._closed
+
+    def close(self):
+        self._closed = True
+
+
+class FakeSnowflake:
+    # SQLite backed stand-in for snowflake.connector. install() registers it in sys.modules, so the handler's lazy
+    # import of the connector resolves to the fake. connect_latency emulates the login handshake and latency every
+    # statement's round trip.
+
+    def __init__(self, path=":memory:", latency=0.0, connect_latency=0.0):
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.latency = latency
+        self.connect_latency = connect_latency
+        self.connects = 0
+        self.statements = 0
+        self.module = types.ModuleType("snowflake.connector")
+        self.module.DictCursor = type("DictCursor", (), {})
+        self.module.connect = self.connect
+        self.module.errors = types.SimpleNamespace(DatabaseError=sqlite3.DatabaseError,
+                                                   ProgrammingError=sqlite3.ProgrammingError)
+
+    def connect(self, **conn_params):
+        if self.connect_latency:
+            time.sleep(self.connect_latency)
+        self.connects += 1
+        return FakeSnowflakeConnection(self)
+
+    def install(self):
+        package = sys.modules.setdefault("snowflake", types.ModuleType("snowflake"))
+        package.connector = self.module
+        sys.modules["snowflake.connector"] = self.module
+        return self
@@ -0,0 +1,21 @@
+import threading
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(service_name):
+    # boto3 is imported and the client created on first use, records that are ignored never pay for either. Clients
+    # are thread safe and kept for the lifetime of the execution environment.
+    with _clients_lock:
+        client = _clients.get(service_name)
+        if client is None:
+            import boto3
+            client = _clients[service_name] = boto3.client(service_name)
+        return client
+
+
+def set_client(service_name, client):
+    # replaces the client used for a service, e.g. with a stub or a client configured for another endpoint
+    with _clients_lock:
+        _clients[service_name] = client
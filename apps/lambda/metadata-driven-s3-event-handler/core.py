@@ -1,43 +1,233 @@
+import copy
+import hashlib
+import importlib
 import json
 import sys
+import threading
+import time
 from abc import abstractmethod
-if sys.version_info >= (3,8):
-    from importlib import metadata
-else:
-    import importlib_metadata as metadata
+from concurrent.futures import FIRST_EXCEPTION
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
 import logging
-import boto3
 from datetime import datetime
 from dateutil import tz
-import snowflake.connector as snowflake_connector
-import rules
+from clients import get_client
+from dedupe import get_dedupe_index
+from metrics import metrics
+from transfer import MB
+from transfer import fan_out_move
 
 
 logger = logging.getLogger()
-s3 = boto3.client('s3')
-s3_resource = boto3.resource('s3')
+
+
+# Raised when a record can not be processed because of the configuration, e.g. an unmapped notification or a prefix
+# without exactly one metadata row. Retrying does not help until the configuration is fixed.
+class ConfigurationError(Exception):
+    pass
+
 
 class StaticEntryPoint:
-    def __init__(self, name, cls_target):
-        self._cls_target = cls_target
+    # same shape as an importlib.metadata entry point, the target module is only imported when the rule is used
+    def __init__(self, name, value):
         self.name = name
+        self.value = value
 
     def load(self):
-        return self._cls_target
+        module_name, attr = self.value.split(":")
+        return getattr(importlib.import_module(module_name), attr)
+
+
+STATIC_RULES = (StaticEntryPoint("s3.file_name_regex_check", "rules:FilenamePatternRegexRule"),
+                StaticEntryPoint("s3.file_size_check", "rules:FilenameSizeRule"),
+                StaticEntryPoint("s3.duplication_check", "rules:FileDuplicationCheckRule"),
+                StaticEntryPoint("s3.schema_check", "rules:HeaderSchemaCheckRule"),
+                StaticEntryPoint("s3.decompress_archive", "rules:DecompressArchive"),
+                StaticEntryPoint("s3.convert_columnar", "rules:ConvertColumnarRule"),
+                StaticEntryPoint("glue.call_job", "rules:CallGlueJob"))
+
+_processing_rules = None
+_processing_rules_lock = threading.Lock()
+
+
+def get_processing_rules():
+    # scanning the installed distributions for entry points is slow, so it is done once per execution environment
+    # and only when the first rule is built
+    global _processing_rules
+    with _processing_rules_lock:
+        if _processing_rules is None:
+            if sys.version_info >= (3,8):
+                from importlib import metadata
+            else:
+                import importlib_metadata as metadata
+            entry_points = metadata.entry_points()
+            if hasattr(entry_points, "select"):
+                entries = tuple(entry_points.select(group="dp.rules")) or STATIC_RULES
+            else:
+                entries = entry_points.get("dp.rules", STATIC_RULES)
+            _processing_rules = {entry.name: entry for entry in set(entries)}
+        return _processing_rules
+
+
+def get_snowflake_connector():
+    # importing the connector costs a few hundred milliseconds of cold start, defer it until a session is needed
+    import snowflake.connector
+    return snowflake.connector
+
+
+def parse_rules_config(config, event_type):
+    logger.info("Parsing rules config from the context init information")
+    rule_configs = {rule_def if rule_def.find("{") < 0 else rule_def[:rule_def.index("{")]:
+                        {} if rule_def.find("{") < 0 else json.loads(rule_def[rule_def.index("{"):])
+                    for rule_def in json.loads(config.get(f"on_{event_type}".upper(),
+                                                          config.get(f"on_{event_type}".lower(), '[]')))}
+    logger.info(f"Found following rule configs: {rule_configs}")
+    return rule_configs
+
+
+def rules_config_hash(rules_config):
+    # rule order is significant, the options of a single rule are not
+    return hashlib.sha256(json.dumps(list(rules_config.items()), sort_keys=True, default=str).encode()).hexdigest()
+
+
+class MetadataCacheEntry:
+
+    def __init__(self, event_type, config, version=None, found=1):
+        self.event_type = event_type
+        self.config = config
+        self.version = version
+        # number of metadata rows matching the bucket path, anything but one is a negative entry without a config
+        self.found = found
+        self.loaded_at = time.monotonic()
+        self._rules_config = None
+        self._rules_config_hash = None
+
+    @classmethod
+    def negative(cls, event_type, found=0):
+        return cls(event_type, None, found=found)
+
+    @property
+    def is_negative(self):
+        return self.found != 1
 
+    def is_fresh(self, ttl):
+        return time.monotonic() - self.loaded_at < ttl
 
-processing_rules = {entry.name: entry for entry in
-                        set(metadata.entry_points().get("dp.rules",
-                                                        (StaticEntryPoint("s3.file_name_regex_check",
-                                                                          rules.FilenamePatternRegexRule),
-                                                         StaticEntryPoint("s3.file_size_check",
-                                                                          rules.FilenameSizeRule),
-                                                         StaticEntryPoint("s3.duplication_check",
-                                                                          rules.FileDuplicationCheckRule),
-                                                         StaticEntryPoint("s3.decompress_archive",
-                                                                          rules.DecompressArchive),
-                                                         StaticEntryPoint("glue.call_job",
-                                                                          rules.CallGlueJob))))}
+    def touch(self):
+        self.loaded_at = time.monotonic()
+
+    @property
+    def rules_config(self):
+        # ON_LANDING/ON_INGESTION json is parsed once per cached row instead of once per file
+        if self._rules_config is None:
+            self._rules_config = parse_rules_config(self.config, self.event_type)
+        return self._rules_config
+
+    @property
+    def rules_config_hash(self):
+        if self._rules_config_hash is None:
+            self._rules_config_hash = rules_config_hash(self.rules_config)
+        return self._rules_config_hash
+
+
+# Ingestion metadata rows keyed by (event_type, bucket path). Kept at module level so warm invocations of the
+# same execution environment skip the metadata lookup until the TTL or the version column says otherwise.
+class MetadataCache:
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            return self._entries.get(key)
+
+    def put(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+
+    def invalidate(self, key=None):
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+
+metadata_cache = MetadataCache()
+
+
+# One authenticated Snowflake session per execution environment, shared by every context of every invocation.
+# The session is health checked before it is handed out and transparently re-established once it has expired.
+class SnowflakeConnectionManager:
+
+    def __init__(self):
+        self._conn = None
+        self._conn_params = None
+        # kept across reconnects, unlike _conn_params which only describes the open session
+        self._latest_params = None
+        self._last_used = 0
+        self._lock = threading.Lock()
+        self.handshakes = 0
+        self.handshakes_avoided = 0
+
+    def get_connection(self, health_check_interval=60, **conn_params):
+        with self._lock:
+            self._latest_params = {"health_check_interval": health_check_interval, **conn_params}
+            if self._conn and self._conn_params == conn_params and self._is_healthy(health_check_interval):
+                self.handshakes_avoided += 1
+                self._last_used = time.monotonic()
+                logger.info(f"Reusing Snowflake session, {self.handshakes_avoided} handshakes avoided so far")
+                return self._conn
+            logger.info(f"Opening Snowflake session to {conn_params.get('account')}")
+            # the open session is only replaced once the new one is established, so a handshake failing with stale
+            # credentials does not close it under the contexts still using it
+            conn = get_snowflake_connector().connect(**conn_params)
+            self._close()
+            self._conn = conn
+            self._conn_params = conn_params
+            self._last_used = time.monotonic()
+            self.handshakes += 1
+            return self._conn
+
+    def get_current_connection(self):
+        # The session with the parameters of the latest context, so long lived users such as the cached dedupe index
+        # follow a credential rotation instead of reconnecting with the parameters they were created with
+        with self._lock:
+            latest_params = self._latest_params
+        if latest_params is None:
+            raise Exception("No Snowflake session was requested yet")
+        return self.get_connection(**latest_params)
+
+    def _is_healthy(self, health_check_interval):
+        if self._conn.is_closed():
+            logger.info("Snowflake session is closed, reconnecting")
+            return False
+        if time.monotonic() - self._last_used < health_check_interval:
+            return True
+        try:
+            self._conn.cursor().execute("SELECT 1").fetchall()
+            return True
+        except Exception as ex:
+            logger.warning(f"Snowflake session failed health check with {ex}, reconnecting")
+            return False
+
+    def _close(self):
+        if self._conn:
+            try:
+                self._conn.close()
+            except Exception as ex:
+                logger.warning(f"Ignoring error while closing stale Snowflake session: {ex}")
+        self._conn = None
+        self._conn_params = None
+
+    def close(self):
+        with self._lock:
+            self._close()
+
+
+connection_manager = SnowflakeConnectionManager()
 
 
 class BaseContext:
@@ -50,13 +240,26 @@ class BaseContext:
         self._event_type = event_type
         self._config = {}
         self._start_time = datetime.utcnow()
+        self._etag = None
 
     @property
     def config(self):
         return self._config
 
+    @property
+    def variables(self):
+        return self._variables
+
+    @property
+    def rules_config_hash(self):
+        return rules_config_hash(self.get_rules_config())
+
+    @property
+    def dedupe_index(self):
+        return None
+
     @abstractmethod
-    def init(self, event_data):
+    def init(self, event_data, etag=None):
         pass
 
     @abstractmethod
@@ -71,6 +274,10 @@ class BaseContext:
     def get_audit_events(self, bucket_name, file_path, file_name, component_name, action_status, timestamp=None):
         pass
 
+    @abstractmethod
+    def flush_audit_events(self):
+        pass
+
     @abstractmethod
     def mark_failed(self, file_key):
         pass
@@ -82,7 +289,7 @@ class BaseContext:
 
 class SnowflakeContext(BaseContext):
 
-    def __init__(self, user, password, **kwargs):
+    def __init__(self, user, password, metadata=None, **kwargs):
         super(SnowflakeContext, self).__init__(**kwargs)
         self._account = self._variables.get("SNOWFLAKE_ACCOUNT")
         self._warehouse = self._variables.get("SNOWFLAKE_WAREHOUSE")
@@ -92,32 +299,145 @@ class SnowflakeContext(BaseContext):
         self._metadata_schema = self._variables.get("SNOWFLAKE_METADATA_SCHEMA")
         self._metadata_rules_table = self._variables.get("SNOWFLAKE_METADATA_TABLE")
         self._event_log_table = self._variables.get("SNOWFLAKE_EVENT_LOG_TABLE")
-        self._conn = False
-        try:
-            self._conn = snowflake_connector.connect(account=self._account,
-                                               warehouse=self._warehouse,
-                                               database=self._metadata_database,
-                                               schema=self._metadata_schema,
-                                               user=self._user,
-                                               password=self._password)
-            query = (f"SELECT * FROM "
-                     f"{self._metadata_database}.{self._metadata_schema}.{self._metadata_rules_table}"
-                     f" WHERE {self._event_type}_bucket_path = '{self._event_source}/{self._event_key}'")
-            logger.info(f"Executing {query}")
-            results = self._conn.cursor(snowflake_connector.DictCursor).execute(query).fetchall()
-            logger.info(f"Results of the query: {results}")
-            if not results or len(results) != 1:
-                raise Exception(f"Expecting exactly one rule with references "
-                                f"{self._event_type}_bucket_path = '{self._event_source}/{self._event_key}', but found "
-                                f"{len(results) if results else 'none'}.")
-            logger.info("Converting results of the query into dict to be used later")
-            self._config = {key.lower():value for key, value in results[0].items()}
-        except Exception as ex:
-            if self._conn:
-                self._conn.close()
-            raise ex
+        self._metadata_cache_ttl = float(self._variables.get("METADATA_CACHE_TTL_SECONDS", 300))
+        self._negative_cache_ttl = float(self._variables.get("METADATA_NEGATIVE_CACHE_TTL_SECONDS", 60))
+        self._metadata_version_column = self._variables.get("SNOWFLAKE_METADATA_VERSION_COLUMN")
+        self._conn_params = self.connection_params(self._variables, user, password)
+        with metrics.timer("Snowflake", "GetConnection"):
+            self._conn = connection_manager.get_connection(**self._conn_params)
+        with metrics.timer("Snowflake", "LoadMetadata"):
+            self._metadata = self._check_metadata(metadata) if metadata else self._load_metadata()
+        self._config = self._metadata.config
+        self._audit_events = []
+        self._audit_lock = threading.Lock()
+
+    @staticmethod
+    def connection_params(variables, user, password):
+        return {"health_check_interval": float(variables.get("SNOWFLAKE_HEALTH_CHECK_SECONDS", 60)),
+                "account": variables.get("SNOWFLAKE_ACCOUNT"),
+                "warehouse": variables.get("SNOWFLAKE_WAREHOUSE"),
+                "database": variables.get("SNOWFLAKE_METADATA_DATABASE"),
+                "schema": variables.get("SNOWFLAKE_METADATA_SCHEMA"),
+                "user": user,
+                "password": password}
+
+    @classmethod
+    def prefetch_metadata(cls, variables, user, password, event_keys):
+        # Resolves the metadata rows of every (event_type, bucket path) in event_keys that is not cached and fresh
+        # with one IN list query per event type, instead of one query per record. Paths without exactly one row are
+        # returned as negative entries, so their records fail without querying again.
+        ttl = float(variables.get("METADATA_CACHE_TTL_SECONDS", 300))
+        negative_ttl = float(variables.get("METADATA_NEGATIVE_CACHE_TTL_SECONDS", 60))
+        version_column = variables.get("SNOWFLAKE_METADATA_VERSION_COLUMN")
+        table = (f"{variables.get('SNOWFLAKE_METADATA_DATABASE')}.{variables.get('SNOWFLAKE_METADATA_SCHEMA')}."
+                 f"{variables.get('SNOWFLAKE_METADATA_TABLE')}")
+        entries, missing = {}, {}
+        for event_type, bucket_path in set(event_keys):
+            cached = metadata_cache.get((event_type, bucket_path))
+            if cached and cached.is_fresh(negative_ttl if cached.is_negative else ttl):
+                entries[(event_type, bucket_path)] = cached
+            else:
+                missing.setdefault(event_type, []).append(bucket_path)
+        if not missing:
+            return entries
+        conn = connection_manager.get_connection(**cls.connection_params(variables, user, password))
+        for event_type, bucket_paths in missing.items():
+            query = (f"SELECT * FROM {table} WHERE {event_type}_bucket_path IN "
+                     f"({', '.join(['%s'] * len(bucket_paths))})")
+            logger.info(f"Prefetching metadata with {query} for {bucket_paths}")
+            with metrics.timer("Snowflake", "PrefetchMetadata"):
+                results = conn.cursor(get_snowflake_connector().DictCursor).execute(query, bucket_paths).fetchall()
+            rows = {}
+            for row in results:
+                config = {key.lower(): value for key, value in row.items()}
+                rows.setdefault(config.get(f"{event_type}_bucket_path"), []).append(config)
+            for bucket_path in bucket_paths:
+                matches = rows.get(bucket_path, [])
+                if len(matches) == 1:
+                    version = matches[0].get(version_column.lower()) if version_column else None
+                    entry = MetadataCacheEntry(event_type, matches[0], version)
+                else:
+                    entry = MetadataCacheEntry.negative(event_type, found=len(matches))
+                cls._store_metadata((event_type, bucket_path), entry, ttl, negative_ttl)
+                entries[(event_type, bucket_path)] = entry
+        return entries
+
+    @staticmethod
+    def _store_metadata(cache_key, entry, ttl, negative_ttl):
+        cached = metadata_cache.get(cache_key)
+        if cached and not cached.is_negative and not entry.is_negative \
+                and cached.rules_config_hash != entry.rules_config_hash:
+            logger.info(f"Rules for {cache_key[0]}_bucket_path = '{cache_key[1]}' changed, "
+                        f"dropping the compiled pipeline")
+            RulesFactory.invalidate(cached.rules_config_hash)
+        if (negative_ttl if entry.is_negative else ttl) > 0:
+            metadata_cache.put(cache_key, entry)
+
+    @property
+    def _metadata_table(self):
+        return f"{self._metadata_database}.{self._metadata_schema}.{self._metadata_rules_table}"
+
+    def _check_metadata(self, entry):
+        if entry.is_negative:
+            raise ConfigurationError(f"Expecting exactly one rule with references "
+                                     f"{self._event_type}_bucket_path = '{self._event_source}/{self._event_key}', "
+                                     f"but found {entry.found if entry.found else 'none'}.")
+        return entry
+
+    def _load_metadata(self):
+        cache_key = (self._event_type, f"{self._event_source}/{self._event_key}")
+        cached = metadata_cache.get(cache_key)
+        if cached and cached.is_negative and cached.is_fresh(self._negative_cache_ttl):
+            return self._check_metadata(cached)
+        if cached and not cached.is_negative and cached.is_fresh(self._metadata_cache_ttl):
+            logger.info(f"Using cached metadata for {self._event_type}_bucket_path = '{cache_key[1]}'")
+            return cached
+        if cached and not cached.is_negative and self._metadata_version_column:
+            version = self._query_metadata_version()
+            if version is not None and version == cached.version:
+                logger.info(f"Metadata for {self._event_type}_bucket_path = '{cache_key[1]}' is unchanged "
+                            f"({self._metadata_version_column} = {version}), extending cached entry")
+                cached.touch()
+                return cached
+        config = self._query_metadata()
+        version = config.get(self._metadata_version_column.lower()) if self._metadata_version_column else None
+        entry = MetadataCacheEntry(self._event_type, config, version)
+        self._store_metadata(cache_key, entry, self._metadata_cache_ttl, self._negative_cache_ttl)
+        return entry
 
-    def init(self, file_key):
+    @property
+    def rules_config_hash(self):
+        return self._metadata.rules_config_hash
+
+    def _query_metadata(self):
+        query = (f"SELECT * FROM {self._metadata_table}"
+                 f" WHERE {self._event_type}_bucket_path = %s")
+        logger.info(f"Executing {query} with '{self._event_source}/{self._event_key}'")
+        results = self._conn.cursor(get_snowflake_connector().DictCursor).execute(
+            query, (f"{self._event_source}/{self._event_key}",)).fetchall()
+        logger.info(f"Results of the query: {results}")
+        if not results or len(results) != 1:
+            raise ConfigurationError(f"Expecting exactly one rule with references "
+                                     f"{self._event_type}_bucket_path = '{self._event_source}/{self._event_key}', "
+                                     f"but found {len(results) if results else 'none'}.")
+        logger.info("Converting results of the query into dict to be used later")
+        return {key.lower(): value for key, value in results[0].items()}
+
+    def _query_metadata_version(self):
+        query = (f"SELECT {self._metadata_version_column} FROM {self._metadata_table}"
+                 f" WHERE {self._event_type}_bucket_path = %s")
+        logger.info(f"Executing {query} with '{self._event_source}/{self._event_key}'")
+        results = self._conn.cursor().execute(query, (f"{self._event_source}/{self._event_key}",)).fetchall()
+        return results[0][0] if results and len(results) == 1 else None
+
+    @property
+    def dedupe_index(self):
+        return get_dedupe_index(self._variables,
+                                connection_provider=connection_manager.get_current_connection,
+                                default_table=f"{self._metadata_database}.{self._metadata_schema}.FILE_DEDUPE_INDEX")
+
+    def init(self, file_key, etag=None):
+        self._etag = etag
         file_keys = file_key.split("/")
         bucket = file_keys[0]
         file_path = "/".join(file_keys[1:-1])
@@ -130,27 +450,31 @@ class SnowflakeContext(BaseContext):
                              action='Processing Context', action_status='INIT')
 
     def get_rules_config(self):
-            logger.info("Parsing rules config from the context init information")
-            rule_configs = {rule_def if rule_def.find("{") < 0 else rule_def[:rule_def.index("{")]:
-                                {} if rule_def.find("{") < 0 else json.loads(rule_def[rule_def.index("{"):])
-                            for rule_def in json.loads(self._config.get(f"on_{self._event_type}".upper(),
-                                                                        self._config.get(f"on_{self._event_type}".lower(),
-                                                                                         '[]')))}
-            logger.info(f"Found following rule configs: {rule_configs}")
-            return rule_configs
+        return copy.deepcopy(self._metadata.rules_config)
 
     def log_audit_event(self, bucket_name, file_path, file_name, component_name, action, action_status, file_timestamp=None):
         local_timezone = tz.gettz("Australia/Queensland") # get local time zone
         local_current_time = datetime.utcnow().astimezone(local_timezone)
-        logger.info(f"Logging audit event to event table with details {bucket_name}, {file_path}, {file_name}, "
+        logger.info(f"Buffering audit event for event table with details {bucket_name}, {file_path}, {file_name}, "
                     f"{file_timestamp}, {component_name}, {action}, {action_status}",)
-        file_ts = f"'{file_timestamp}'" if file_timestamp else "NULL"
+        with self._audit_lock:
+            self._audit_events.append((self._config.get('source_name'), self._config.get('generic_file_name'),
+                                       bucket_name, file_path, file_name, file_timestamp if file_timestamp else None,
+                                       f"{self._event_type}/{component_name}", f"{action}", action_status,
+                                       local_current_time.strftime('%Y-%m-%d %H:%M:%S')))
+
+    def flush_audit_events(self):
+        # all events buffered by the context go out as a single multi-row insert with bind variables
+        with self._audit_lock:
+            audit_events, self._audit_events = self._audit_events, []
+        if not audit_events:
+            return
         query = (f"INSERT INTO {self._metadata_database}.{self._metadata_schema}.{self._event_log_table} "
-                 f"VALUES ('{self._config.get('source_name')}', '{self._config.get('generic_file_name')}', "
-                 f"'{bucket_name}', '{file_path}', '{file_name}', {file_ts}, '{self._event_type}/{component_name}', "
-                 f"'{action}', '{action_status}', '{local_current_time.strftime('%Y-%m-%d %H:%M:%S')}')")
-        logger.info(f"Executing {query}")
-        self._conn.cursor().execute(query)
+                 f"VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)")
+        logger.info(f"Executing {query} for {len(audit_events)} audit events")
+        with metrics.timer("Snowflake", "FlushAuditEvents", source_name=self._config.get("source_name"),
+                           generic_file_name=self._config.get("generic_file_name")):
+            self._conn.cursor().executemany(query, audit_events)
 
     def get_audit_events(self, bucket_name, file_path, file_name, component_name, action_status, timestamp=None):
         query = (f"SELECT * FROM {self._metadata_database}.{self._metadata_schema}.{self._event_log_table}"
@@ -191,8 +515,11 @@ class SnowflakeContext(BaseContext):
                                  action='Processing Context', action_status='FAILED')
             failure_call_ref(file_key)
         finally:
-            if self._conn:
-                self._conn.close()
+            try:
+                self.flush_audit_events()
+            finally:
+                # the session belongs to connection_manager and is kept open for the next record
+                self._conn = None
 
     def mark_success(self, file_key):
         success_call_ref = {"landing": self._landing_success, "ingestion": self._ingestion_success}.get(self._event_type)
@@ -203,38 +530,55 @@ class SnowflakeContext(BaseContext):
             file_path = "/".join(file_keys[1:-1])
             file_name = file_keys[-1]
             logger.info(f"Marking processing {file_key} as success")
+            dedupe_index = self.dedupe_index
+            if dedupe_index:
+                try:
+                    dedupe_index.record(bucket, file_path, file_name, etag=self._etag)
+                except Exception as ex:
+                    # the file is already moved, a missing index entry must not turn the landing into a failure
+                    logger.error(f"Could not record {file_key} in the dedupe index: {ex}")
             self.log_audit_event(bucket_name=bucket,
                                  file_path=file_path,
                                  file_name=file_name,
                                  component_name="Context",
                                  action='Processing Context', action_status='SUCCESS')
         finally:
-            if self._conn:
-                self._conn.close()
+            try:
+                self.flush_audit_events()
+            finally:
+                self._conn = None
+
+    def _archive_key(self, file_keys):
+        return f"archives/{'/'.join(file_keys[1:-1])}{self._start_time.strftime('/%Y/%m/%d/%H%M%S_')}{file_keys[-1]}"
+
+    def _move(self, file_keys, destinations):
+        with metrics.timer("S3", "Move", source_name=self._config.get("source_name"),
+                           generic_file_name=self._config.get("generic_file_name")) as measurement:
+            size = fan_out_move(get_client('s3'), file_keys[0], '/'.join(file_keys[1:]), destinations,
+                                multipart_threshold=int(float(self._variables.get("MOVE_MULTIPART_THRESHOLD_MB", 64)) * MB),
+                                part_size=int(float(self._variables.get("MOVE_PART_SIZE_MB", 64)) * MB),
+                                max_concurrency=int(self._variables.get("MOVE_MAX_CONCURRENCY", 10)))
+            measurement["bytes_touched"] = size * len(destinations)
+        return size
 
     def _landing_success(self, file_key):
         file_keys = file_key.split("/")
-        copy_file = {"Bucket": file_keys[0],"Key": '/'.join(file_keys[1:])} 
-        s3_resource.meta.client.copy(copy_file, f"{file_keys[0]}", f"archives/{'/'.join(file_keys[1:-1])}{self._start_time.strftime('/%Y/%m/%d/%H%M%S_')}{file_keys[-1]}")
+        destinations = [(file_keys[0], self._archive_key(file_keys))]
         target_bucket = self._config.get("ingestion_bucket_path").split('/')[0] \
             if self._config.get("ingestion_bucket_path") else None
         if target_bucket:
             target_bucket_key = "/".join(self._config.get("ingestion_bucket_path").split('/')[1:])
             logger.info(f"Copying file {file_key} to {target_bucket}/{target_bucket_key}/{file_keys[-1]}")
-            s3_resource.meta.client.copy(copy_file, f"{target_bucket}", f"{target_bucket_key}/{file_keys[-1]}")
-        s3_resource.Object(f"{file_key.split('/')[0]}", f"{'/'.join(file_key.split('/')[1:])}").delete()
-            
+            destinations.append((target_bucket, f"{target_bucket_key}/{file_keys[-1]}"))
+        self._move(file_keys, destinations)
 
     def _landing_failure(self, file_key):
         target_bucket = self._config.get("rejection_bucket_path").split('/')[0]
         target_bucket_key = "/".join(self._config.get("rejection_bucket_path").split('/')[1:])
         logger.info(f"Copying file {file_key} to {target_bucket}/{target_bucket_key}/{file_key.split('/')[-1]}")
         file_keys = file_key.split("/")
-        copy_file = {"Bucket": file_keys[0],"Key": '/'.join(file_keys[1:])}         
-        s3_resource.meta.client.copy(copy_file, f"{file_keys[0]}", f"archives/{'/'.join(file_keys[1:-1])}{self._start_time.strftime('/%Y/%m/%d/%H%M%S_')}{file_keys[-1]}")
-        s3_resource.meta.client.copy(copy_file, f"{target_bucket}", f"{target_bucket_key}/{file_keys[-1]}")
-        s3_resource.Object(f"{file_key.split('/')[0]}", f"{'/'.join(file_keys[1:])}").delete()
-
+        self._move(file_keys, [(file_keys[0], self._archive_key(file_keys)),
+                               (target_bucket, f"{target_bucket_key}/{file_keys[-1]}")])
 
     def _ingestion_success(self, file_name):
         pass
@@ -243,25 +587,100 @@ class SnowflakeContext(BaseContext):
         pass
 
 
+class RuleEngine:
+    # Runs the rules of a record by cost instead of strictly in list order. Pure validations run inline first, io
+    # validations run concurrently once those passed, and actions run last in their configured order, so a side
+    # effect only happens after every validation passed. The first failing validation stops the run and validations
+    # that have not started yet are cancelled. Rules without a kind are treated as actions.
+
+    def __init__(self, max_workers=4):
+        self._max_workers = max_workers
+
+    @staticmethod
+    def plan(rules):
+        kinds = [getattr(rule, "kind", "action") for rule in rules]
+        return ([rule for rule, kind in zip(rules, kinds) if kind == "pure"],
+                [rule for rule, kind in zip(rules, kinds) if kind == "io"],
+                [rule for rule, kind in zip(rules, kinds) if kind not in ("pure", "io")])
+
+    def run(self, rules, context, data):
+        pure, io, actions = self.plan(rules)
+        logger.info(f"Rule plan: {len(pure)} pure validations, {len(io)} io validations, {len(actions)} actions")
+        for rule in pure:
+            rule.apply(context, data)
+        if len(io) > 1 and self._max_workers > 1:
+            self._run_concurrently(io, context, data)
+        else:
+            for rule in io:
+                rule.apply(context, data)
+        for rule in actions:
+            rule.apply(context, data)
+
+    def _run_concurrently(self, rules, context, data):
+        executor = ThreadPoolExecutor(max_workers=min(self._max_workers, len(rules)))
+        try:
+            futures = [executor.submit(rule.apply, context, data) for rule in rules]
+            done, pending = wait(futures, return_when=FIRST_EXCEPTION)
+            failed = [future for future in futures if future in done and future.exception()]
+            if failed:
+                for future in pending:
+                    future.cancel()
+                raise failed[0].exception()
+        finally:
+            # running validations are waited for, they log audit events that are flushed with the record outcome
+            executor.shutdown(wait=True)
+
+
 class RulesFactory:
 
     # EVENT_DICTIONARY = {"ObjectCreated:Put": "put"}
     # EVENT_SOURCE_IDS = {"landing": "LANDING_BUCKET"}
 
+    # Compiled pipelines keyed by the hash of the rule config. Rules keep no per file state, so the instances
+    # (with their precompiled patterns) are shared by every record and warm invocation until invalidated.
+    _pipelines = {}
+    _rule_classes = {}
+    _lock = threading.Lock()
+
     @classmethod
     def build_rules(cls, context):
+        pipeline_key = context.rules_config_hash
+        with cls._lock:
+            pipeline = cls._pipelines.get(pipeline_key)
+        if pipeline is not None:
+            logger.info(f"Using compiled rule pipeline {pipeline_key[:12]}")
+            return list(pipeline)
         rules_config = context.get_rules_config()
         factory = RulesFactory()
         rules = []
         for rule_key, rule_config in rules_config.items():
             rule = factory.build_rule(rule_key, rule_config)
             rules.append(rule)
-        return rules
+        with cls._lock:
+            cls._pipelines[pipeline_key] = rules
+        return list(rules)
+
+    @classmethod
+    def invalidate(cls, pipeline_key=None):
+        with cls._lock:
+            if pipeline_key is None:
+                cls._pipelines.clear()
+            else:
+                cls._pipelines.pop(pipeline_key, None)
+
+    @classmethod
+    def rule_class(cls, rule_key):
+        with cls._lock:
+            rule_cls = cls._rule_classes.get(rule_key)
+        if rule_cls is None:
+            rule_cls_def = get_processing_rules().get(rule_key)
+            if not rule_cls_def:
+                raise Exception(f"No rules found for {rule_key}")
+            rule_cls = rule_cls_def.load()
+            with cls._lock:
+                cls._rule_classes[rule_key] = rule_cls
+        return rule_cls
 
     def build_rule(self, rule_key, rule_config):
         logger.info(f"Loading rule for {rule_key} with config {rule_config}")
-        rule_cls_def = processing_rules.get(rule_key)
-        if rule_cls_def:
-            return rule_cls_def.load()(**rule_config)
-        else:
-            raise Exception("No rules found for")
\ No newline at end of file
+        return self.rule_class(rule_key)(**rule_config)
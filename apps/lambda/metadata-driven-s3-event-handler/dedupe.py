@@ -0,0 +1,212 @@
+import hashlib
+import logging
+import math
+import sqlite3
+import threading
+import time
+from abc import ABC
+from abc import abstractmethod
+from datetime import datetime
+
+logger = logging.getLogger()
+
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def file_key(bucket, path, name):
+    return f"{bucket}/{path}/{name}" if path else f"{bucket}/{name}"
+
+
+class DedupeIndex(ABC):
+    # Narrow index of successfully landed files keyed on (bucket, path, name, optional ETag). It answers the
+    # duplication check with a point lookup instead of scanning the event log table.
+
+    @abstractmethod
+    def count(self, bucket, path, name, etag=None, since=None):
+        pass
+
+    @abstractmethod
+    def record(self, bucket, path, name, etag=None, landed_at=None):
+        pass
+
+    @abstractmethod
+    def iter_keys(self, since=None):
+        pass
+
+
+class SnowflakeDedupeIndex(DedupeIndex):
+    # Expects a table clustered on FILE_KEY so lookups prune down to a single micro partition:
+    #
+    #   CREATE TABLE IF NOT EXISTS <DB>.<SCHEMA>.FILE_DEDUPE_INDEX (FILE_KEY VARCHAR, ETAG VARCHAR, LANDED_AT TIMESTAMP_NTZ)
+    #       CLUSTER BY (FILE_KEY);
+    #
+    # and can be backfilled from the event log with
+    #
+    #   INSERT INTO <DB>.<SCHEMA>.FILE_DEDUPE_INDEX
+    #   SELECT BUCKET_NAME || '/' || FILE_PATH || '/' || FILE_NAME, NULL, ACTION_TIMESTAMP FROM <EVENT_LOG_TABLE>
+    #   WHERE COMPONENT_NAME LIKE '%/Context' AND ACTION_STATUS = 'SUCCESS';
+
+    def __init__(self, connection_provider, table):
+        self._connection = connection_provider
+        self._table = table
+
+    def count(self, bucket, path, name, etag=None, since=None):
+        query = f"SELECT COUNT(*) FROM {self._table} WHERE FILE_KEY = %s"
+        params = [file_key(bucket, path, name)]
+        if etag:
+            query += " AND ETAG = %s"
+            params.append(etag)
+        if since:
+            query += " AND LANDED_AT > %s"
+            params.append(since.strftime(TIMESTAMP_FORMAT))
+        logger.info(f"Executing {query} with {params}")
+        return self._connection().cursor().execute(query, params).fetchone()[0]
+
+    def record(self, bucket, path, name, etag=None, landed_at=None):
+        query = f"INSERT INTO {self._table} (FILE_KEY, ETAG, LANDED_AT) VALUES (%s, %s, %s)"
+        landed_at = landed_at or datetime.utcnow()
+        self._connection().cursor().execute(query, (file_key(bucket, path, name), etag,
+                                                    landed_at.strftime(TIMESTAMP_FORMAT)))
+
+    def iter_keys(self, since=None):
+        query = f"SELECT DISTINCT FILE_KEY FROM {self._table}"
+        params = []
+        if since:
+            query += " WHERE LANDED_AT > %s"
+            params.append(since)
+        for row in self._connection().cursor().execute(query, params):
+            yield row[0]
+
+
+class SQLiteDedupeIndex(DedupeIndex):
+
+    def __init__(self, path=":memory:"):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._db:
+            self._db.execute("CREATE TABLE IF NOT EXISTS FILE_DEDUPE_INDEX "
+                             "(FILE_KEY TEXT NOT NULL, ETAG TEXT, LANDED_AT TEXT NOT NULL)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS FILE_DEDUPE_INDEX_KEY "
+                             "ON FILE_DEDUPE_INDEX (FILE_KEY, ETAG, LANDED_AT)")
+
+    def count(self, bucket, path, name, etag=None, since=None):
+        query = "SELECT COUNT(*) FROM FILE_DEDUPE_INDEX WHERE FILE_KEY = ?"
+        params = [file_key(bucket, path, name)]
+        if etag:
+            query += " AND ETAG = ?"
+            params.append(etag)
+        if since:
+            query += " AND LANDED_AT > ?"
+            params.append(since.strftime(TIMESTAMP_FORMAT))
+        with self._lock:
+            return self._db.execute(query, params).fetchone()[0]
+
+    def record(self, bucket, path, name, etag=None, landed_at=None):
+        landed_at = landed_at or datetime.utcnow()
+        with self._lock, self._db:
+            self._db.execute("INSERT INTO FILE_DEDUPE_INDEX (FILE_KEY, ETAG, LANDED_AT) VALUES (?, ?, ?)",
+                             (file_key(bucket, path, name), etag, landed_at.strftime(TIMESTAMP_FORMAT)))
+
+    def iter_keys(self, since=None):
+        query = "SELECT DISTINCT FILE_KEY FROM FILE_DEDUPE_INDEX"
+        params = []
+        if since:
+            query += " WHERE LANDED_AT > ?"
+            params.append(since)
+        with self._lock:
+            rows = self._db.execute(query, params).fetchall()
+        return (row[0] for row in rows)
+
+
+class BloomFilter:
+
+    def __init__(self, capacity, error_rate):
+        self.size = max(8, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, value):
+        digest = hashlib.blake2b(value.encode(), digest_size=16).digest()
+        first, second = int.from_bytes(digest[:8], "little"), int.from_bytes(digest[8:], "little") | 1
+        return ((first + i * second) % self.size for i in range(self.hashes))
+
+    def add(self, value):
+        for position in self._positions(value):
+            self._bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, value):
+        return all(self._bits[position >> 3] & (1 << (position & 7)) for position in self._positions(value))
+
+
+class BloomPrefilteredDedupeIndex(DedupeIndex):
+    # Answers the common "never seen" case from an in-memory Bloom filter and only asks the backing index when the
+    # file key may have been landed before. The filter is loaded from the backing index on first use and topped up
+    # every refresh_seconds, so a file landed by another execution environment within that window can be missed.
+
+    def __init__(self, index, capacity=1000000, error_rate=0.01, refresh_seconds=60):
+        self._index = index
+        self._bloom = BloomFilter(capacity, error_rate)
+        self._refresh_seconds = refresh_seconds
+        self._refreshed_at = None
+        self._watermark = None
+        self._lock = threading.Lock()
+        self.prefiltered = 0
+
+    def _refresh(self):
+        with self._lock:
+            if self._refreshed_at is not None and time.monotonic() - self._refreshed_at < self._refresh_seconds:
+                return
+            watermark = datetime.utcnow().strftime(TIMESTAMP_FORMAT)
+            loaded = 0
+            for key in self._index.iter_keys(since=self._watermark):
+                self._bloom.add(key)
+                loaded += 1
+            logger.info(f"Loaded {loaded} file keys into the dedupe Bloom filter since {self._watermark}")
+            self._watermark = watermark
+            self._refreshed_at = time.monotonic()
+
+    def count(self, bucket, path, name, etag=None, since=None):
+        self._refresh()
+        if file_key(bucket, path, name) not in self._bloom:
+            self.prefiltered += 1
+            return 0
+        return self._index.count(bucket, path, name, etag=etag, since=since)
+
+    def record(self, bucket, path, name, etag=None, landed_at=None):
+        self._index.record(bucket, path, name, etag=etag, landed_at=landed_at)
+        self._bloom.add(file_key(bucket, path, name))
+
+    def iter_keys(self, since=None):
+        return self._index.iter_keys(since=since)
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_dedupe_index(variables, connection_provider, default_table):
+    # Built once per backend configuration and kept for warm invocations, so a Bloom filter is only loaded once
+    backend = (variables.get("DEDUPE_INDEX_BACKEND") or "").lower()
+    if not backend:
+        return None
+    prefilter = str(variables.get("DEDUPE_BLOOM_PREFILTER", "false")).lower() == "true"
+    table = variables.get("DEDUPE_INDEX_TABLE", default_table)
+    sqlite_path = variables.get("DEDUPE_INDEX_SQLITE_PATH", "/tmp/dedupe_index.db")
+    cache_key = (backend, table, sqlite_path, prefilter)
+    with _indexes_lock:
+        index = _indexes.get(cache_key)
+        if index is None:
+            if backend == "snowflake":
+                index = SnowflakeDedupeIndex(connection_provider, table)
+            elif backend == "sqlite":
+                index = SQLiteDedupeIndex(sqlite_path)
+            else:
+                raise Exception(f"Dedupe index backend {backend} is not supported, expecting snowflake or sqlite")
+            if prefilter:
+                index = BloomPrefilteredDedupeIndex(index,
+                                                    capacity=int(variables.get("DEDUPE_BLOOM_CAPACITY", 1000000)),
+                                                    error_rate=float(variables.get("DEDUPE_BLOOM_ERROR_RATE", 0.01)),
+                                                    refresh_seconds=float(
+                                                        variables.get("DEDUPE_BLOOM_REFRESH_SECONDS", 60)))
+            _indexes[cache_key] = index
+    return index
@@ -0,0 +1,146 @@
+import json
+import logging
+import random
+import threading
+import time
+import uuid
+from concurrent.futures import Future
+from datetime import datetime
+
+from clients import get_client
+
+logger = logging.getLogger()
+
+# errors Glue raises while it is saturated, retrying them later succeeds
+THROTTLING_ERRORS = {"ConcurrentRunsExceededException", "ThrottlingException", "OperationTimeoutException"}
+
+
+def error_code(ex):
+    return getattr(ex, "response", {}).get("Error", {}).get("Code")
+
+
+class AdaptiveWindow:
+    # Coalescing window per job that backs off like TCP congestion control: every throttled start doubles it up to
+    # max_window, every successful start shrinks it by a tenth of the base window, so bursts coalesce into fewer and
+    # larger job runs while Glue is saturated and latency returns to normal once it is not. A job can set its own base
+    # window through get, the others use base_window.
+
+    def __init__(self, base_window, max_window):
+        self._base_window = base_window
+        self._max_window = max(max_window, base_window)
+        self._bases = {}
+        self._windows = {}
+        self._lock = threading.Lock()
+
+    def get(self, job_name, base_window=None):
+        with self._lock:
+            if base_window is not None:
+                self._bases[job_name] = base_window
+            return self._windows.get(job_name, self._bases.get(job_name, self._base_window))
+
+    def throttled(self, job_name):
+        with self._lock:
+            base_window = self._bases.get(job_name, self._base_window)
+            window = min(max(self._windows.get(job_name, base_window), 0.1) * 2, max(self._max_window, base_window))
+            self._windows[job_name] = window
+        logger.warning(f"Glue is throttling {job_name}, coalescing window raised to {window:.1f}s")
+
+    def succeeded(self, job_name):
+        with self._lock:
+            base_window = self._bases.get(job_name, self._base_window)
+            window = self._windows.get(job_name, base_window)
+            self._windows[job_name] = max(base_window, window - base_window / 10)
+
+
+def start_job_run(job_name, job_args, max_attempts=5, backoff_seconds=1.0, window=None):
+    # start_job_run with exponential backoff and full jitter on throttling, other errors are raised at once
+    glue = get_client('glue')
+    for attempt in range(1, max_attempts + 1):
+        try:
+            response = glue.start_job_run(JobName=job_name, Arguments=job_args)
+            if window:
+                window.succeeded(job_name)
+            return response
+        except Exception as ex:
+            if error_code(ex) not in THROTTLING_ERRORS or attempt == max_attempts:
+                raise
+            if window:
+                window.throttled(job_name)
+            delay = random.uniform(0, backoff_seconds * 2 ** (attempt - 1))
+            logger.warning(f"Glue job {job_name} start throttled with {error_code(ex)}, attempt {attempt} of "
+                           f"{max_attempts}, retrying in {delay:.2f}s")
+            time.sleep(delay)
+
+
+class GlueJobBatcher:
+    # Coalesces the files of concurrently processed records into one job run per (job name, job arguments). A batch
+    # is started once it holds max_files files or its window elapsed, whichever comes first, window_seconds sets the
+    # base of the adaptive window of the job. The run carries the S3 URI of a JSON manifest listing the files in
+    # --manifest_path and their number in --file_count. Every record waits on the future of its batch, so a failed
+    # start fails all the records of the batch.
+
+    def __init__(self, base_window=2.0, max_window=30.0):
+        self.window = AdaptiveWindow(base_window, max_window)
+        self._batches = {}
+        self._lock = threading.Lock()
+        self.runs_started = 0
+        self.files_batched = 0
+
+    def submit(self, job_name, job_args, file_path, manifest_location, max_files=50, window_seconds=None,
+               max_attempts=5, backoff_seconds=1.0):
+        key = (job_name, json.dumps(job_args, sort_keys=True, default=str))
+        future = Future()
+        with self._lock:
+            batch = self._batches.get(key)
+            if batch is None:
+                window = self.window.get(job_name, window_seconds)
+                batch = {"job_name": job_name, "job_args": job_args, "manifest_location": manifest_location,
+                         "max_attempts": max_attempts, "backoff_seconds": backoff_seconds, "files": [],
+                         "futures": []}
+                batch["timer"] = threading.Timer(window, self._flush, (key, batch))
+                batch["timer"].daemon = True
+                self._batches[key] = batch
+                batch["timer"].start()
+            batch["files"].append(file_path)
+            batch["futures"].append(future)
+            full = len(batch["files"]) >= max_files
+            if full:
+                del self._batches[key]
+        if full:
+            batch["timer"].cancel()
+            self._start(batch)
+        return future
+
+    def _flush(self, key, batch):
+        with self._lock:
+            # a full batch was already started by the record that filled it
+            if self._batches.get(key) is not batch:
+                return
+            del self._batches[key]
+        self._start(batch)
+
+    def _start(self, batch):
+        try:
+            bucket, _, prefix = batch["manifest_location"].replace("s3://", "").partition("/")
+            manifest_key = (f"{prefix.rstrip('/')}/{batch['job_name']}/"
+                            f"{datetime.utcnow().strftime('%Y/%m/%d/%H%M%S')}_{uuid.uuid4().hex}.json").lstrip("/")
+            get_client('s3').put_object(Bucket=bucket, Key=manifest_key, ContentType="application/json",
+                                        Body=json.dumps({"job_name": batch["job_name"],
+                                                         "files": batch["files"]}).encode())
+            job_args = {**batch["job_args"], "--manifest_path": f"s3://{bucket}/{manifest_key}",
+                        "--file_count": str(len(batch["files"]))}
+            response = start_job_run(batch["job_name"], job_args, max_attempts=batch["max_attempts"],
+                                     backoff_seconds=batch["backoff_seconds"], window=self.window)
+            with self._lock:
+                self.runs_started += 1
+                self.files_batched += len(batch["files"])
+            logger.info(f"Started {batch['job_name']} run {response.get('JobRunId')} for {len(batch['files'])} files "
+                        f"listed in s3://{bucket}/{manifest_key}")
+            for future in batch["futures"]:
+                future.set_result(response)
+        except Exception as ex:
+            for future in batch["futures"]:
+                future.set_exception(ex)
+
+
+glue_job_batcher = GlueJobBatcher()
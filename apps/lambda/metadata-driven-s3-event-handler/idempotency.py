@@ -0,0 +1,117 @@
+import logging
+import sqlite3
+import threading
+import time
+from abc import ABC
+from abc import abstractmethod
+
+logger = logging.getLogger()
+
+IN_PROGRESS = "IN_PROGRESS"
+
+
+def idempotency_key(record):
+    # A re-delivered notification repeats the sequencer of the original, a new upload of the same key gets a new one.
+    # The version id, or the ETag in unversioned buckets, pins the object content.
+    s3_object = record.get("s3", {}).get("object", {})
+    return (f"{record.get('s3', {}).get('bucket', {}).get('name')}/{s3_object.get('key')}"
+            f"#{s3_object.get('versionId') or s3_object.get('eTag') or ''}#{s3_object.get('sequencer') or ''}")
+
+
+class IdempotencyStore(ABC):
+    # Records the notifications being processed and processed already. begin claims a key and returns None, or the
+    # state of the live claim when the key is a duplicate. complete keeps the outcome for ttl seconds, release drops
+    # the claim so a redelivery is processed again.
+
+    @abstractmethod
+    def begin(self, key, ttl):
+        pass
+
+    @abstractmethod
+    def complete(self, key, state, ttl):
+        pass
+
+    @abstractmethod
+    def release(self, key):
+        pass
+
+
+class InMemoryIdempotencyStore(IdempotencyStore):
+    # Only sees the redeliveries that reach the same execution environment
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def begin(self, key, ttl):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[1] > now:
+                return entry[0]
+            self._entries[key] = (IN_PROGRESS, now + ttl)
+            if len(self._entries) > 10000:
+                self._entries = {key: entry for key, entry in self._entries.items() if entry[1] > now}
+        return None
+
+    def complete(self, key, state, ttl):
+        with self._lock:
+            self._entries[key] = (state, time.time() + ttl)
+
+    def release(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+class SQLiteIdempotencyStore(IdempotencyStore):
+
+    def __init__(self, path=":memory:"):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._db:
+            self._db.execute("CREATE TABLE IF NOT EXISTS IDEMPOTENCY_KEYS "
+                             "(IDEMPOTENCY_KEY TEXT PRIMARY KEY, STATE TEXT NOT NULL, EXPIRES_AT REAL NOT NULL)")
+
+    def begin(self, key, ttl):
+        now = time.time()
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM IDEMPOTENCY_KEYS WHERE IDEMPOTENCY_KEY = ? AND EXPIRES_AT <= ?", (key, now))
+            claimed = self._db.execute("INSERT OR IGNORE INTO IDEMPOTENCY_KEYS (IDEMPOTENCY_KEY, STATE, EXPIRES_AT) "
+                                       "VALUES (?, ?, ?)", (key, IN_PROGRESS, now + ttl)).rowcount
+            if claimed:
+                return None
+            return self._db.execute("SELECT STATE FROM IDEMPOTENCY_KEYS WHERE IDEMPOTENCY_KEY = ?",
+                                    (key,)).fetchone()[0]
+
+    def complete(self, key, state, ttl):
+        with self._lock, self._db:
+            self._db.execute("INSERT OR REPLACE INTO IDEMPOTENCY_KEYS (IDEMPOTENCY_KEY, STATE, EXPIRES_AT) "
+                             "VALUES (?, ?, ?)", (key, state, time.time() + ttl))
+
+    def release(self, key):
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM IDEMPOTENCY_KEYS WHERE IDEMPOTENCY_KEY = ?", (key,))
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_idempotency_store(variables):
+    # Built once per backend configuration and kept for warm invocations
+    backend = (variables.get("IDEMPOTENCY_STORE") or "").lower()
+    if not backend:
+        return None
+    sqlite_path = variables.get("IDEMPOTENCY_SQLITE_PATH", "/tmp/idempotency.db")
+    cache_key = (backend, sqlite_path)
+    with _stores_lock:
+        store = _stores.get(cache_key)
+        if store is None:
+            if backend == "memory":
+                store = InMemoryIdempotencyStore()
+            elif backend == "sqlite":
+                store = SQLiteIdempotencyStore(sqlite_path)
+            else:
+                raise Exception(f"Idempotency store {backend} is not supported, expecting memory or sqlite")
+            _stores[cache_key] = store
+    return store
@@ -3,11 +3,20 @@ import os
 import json
 import logging
 import traceback
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
+from core import ConfigurationError
+from core import RuleEngine
 from core import RulesFactory
 from core import SnowflakeContext
-import boto3
-from botocore.exceptions import ClientError
+from core import connection_manager
+from idempotency import IN_PROGRESS
+from idempotency import get_idempotency_store
+from idempotency import idempotency_key
+from metrics import metrics
+from secrets_cache import is_authentication_error
+from secrets_cache import secrets_cache
 
 
 logger = logging.getLogger()
@@ -19,64 +28,212 @@ console.setFormatter(formater)
 logger.addHandler(console)
 
 
-def get_secrets(secret_arn):
+def get_secrets(secret_arn, refresh=False):
+    # served from the process wide cache, Secrets Manager is only called once per secret and TTL
     logger.info(f"Retriving secrets from secrets manager {secret_arn}")
     if secret_arn:
-        client = boto3.client(service_name='secretsmanager', region_name='ap-southeast-2')
-        get_secret_value_response = client.get_secret_value(
-            SecretId=secret_arn
-        )
-        secret = get_secret_value_response['SecretString']
-        return json.loads(secret, strict=False)
+        return secrets_cache.get(secret_arn, region_name='ap-southeast-2', refresh=refresh)
     else:
         raise Exception("Snowflake secret is missing, requires for connection to metadata store")
 
 
+def create_context(context, context_variables, event_details, metadata=None):
+    # the secret is read from the cache for every context, so a refresh by one record reaches the records after it
+    secrets = get_secrets(context_variables.get("SNOWFLAKE_SECRET_ARN"))
+    try:
+        return SnowflakeContext(context=context, variables=context_variables, metadata=metadata, **secrets,
+                                **event_details)
+    except Exception as ex:
+        if not is_authentication_error(ex):
+            raise
+        # the secret may have been rotated since it was cached, retry once with the current version
+        logger.warning(f"Snowflake rejected the cached credentials with {ex}, refreshing the secret")
+        secrets = get_secrets(context_variables.get("SNOWFLAKE_SECRET_ARN"), refresh=True)
+        return SnowflakeContext(context=context, variables=context_variables, metadata=metadata, **secrets,
+                                **event_details)
+
+
+def get_event_details(record, events_mappings):
+    event_type = events_mappings.get(record.get("s3").get("configurationId"), False)
+    if not event_type:
+        raise ConfigurationError(f"Could not find event type mapped to the configuration id "
+                                 f"{record.get('s3').get('configurationId')}")
+    return {"event_source": record.get("s3").get("bucket").get("name"),
+            "event_key": f"{'/'.join(record.get('s3').get('object').get('key').split('/')[:-1])}",
+            "event_type": event_type}
+
+
+def prefetch_metadata(records, events_mappings, context_variables):
+    # one metadata query for all the prefixes of the batch instead of one per record, records keep looking up their
+    # own metadata when the prefetch is disabled or fails
+    if str(context_variables.get("METADATA_PREFETCH", "true")).lower() != "true":
+        return {}
+    event_keys = set()
+    for record in records:
+        if is_processable(record) and events_mappings.get(record.get("s3").get("configurationId")):
+            details = get_event_details(record, events_mappings)
+            event_keys.add((details["event_type"], f"{details['event_source']}/{details['event_key']}"))
+    if not event_keys:
+        return {}
+    try:
+        return SnowflakeContext.prefetch_metadata(context_variables, event_keys=event_keys,
+                                                  **get_secrets(context_variables.get("SNOWFLAKE_SECRET_ARN")))
+    except Exception as ex:
+        logger.warning(f"Could not prefetch metadata for {len(event_keys)} prefixes, exception is raised as {ex}")
+        return {}
+
+
+def is_processable(record):
+    # created objects only, folder markers and files already moved to the archives are ignored
+    return record.get("eventSource", "") == "aws:s3" and record.get("eventName", "").split(":")[0] == "ObjectCreated" \
+        and not(record.get("s3", {}).get("object", {}).get("key", "/").endswith("/"))\
+        and not(record.get("s3", {}).get("object", {}).get("key", "/").startswith("archives/"))
+
+
+def process_record(record, context, events_mappings, context_variables, prefetched=None):
+    # S3 delivers notifications at least once, a redelivery of a notification that has been processed returns DUPLICATE
+    # without running any rule, one that is still being processed elsewhere returns IN_PROGRESS so it is retried until
+    # that claim completes or expires. Claims of records that could not be completed are released, so the retry is
+    # processed.
+    store = get_idempotency_store(context_variables) if is_processable(record) else None
+    if store is None:
+        return handle_record(record, context, events_mappings, context_variables, prefetched)
+    key = idempotency_key(record)
+    state = store.begin(key, ttl=float(context_variables.get("IDEMPOTENCY_IN_PROGRESS_TTL_SECONDS", 900)))
+    if state:
+        logger.warning(f"Skipping redelivered notification {key}, already {state}")
+        return {"record": key.split("#")[0], "status": IN_PROGRESS if state == IN_PROGRESS else "DUPLICATE",
+                "error": None}
+    outcome = None
+    try:
+        outcome = handle_record(record, context, events_mappings, context_variables, prefetched)
+    finally:
+        if outcome and outcome["status"] in ("SUCCESS", "FAILED"):
+            store.complete(key, outcome["status"], ttl=float(context_variables.get("IDEMPOTENCY_TTL_SECONDS", 86400)))
+        else:
+            store.release(key)
+    return outcome
+
+
+def handle_record(record, context, events_mappings, context_variables, prefetched=None):
+    # every record owns its context, so its audit trail and failure handling are isolated from the other records
+    file_key = f"{record.get('s3', {}).get('bucket', {}).get('name')}/{record.get('s3', {}).get('object', {}).get('key')}"
+    outcome = {"record": file_key, "status": "IGNORED", "error": None}
+    snowflake_context = False
+    if is_processable(record):
+        logger.info(f"Processing {record.get('eventName')} event for {file_key}")
+        try:
+            event_details = get_event_details(record, events_mappings)
+            event_type = event_details["event_type"]
+            metadata = (prefetched or {}).get((event_type,
+                                               f"{event_details['event_source']}/{event_details['event_key']}"))
+            logger.info(f"Creating snowflake context for the file processing with {event_details}")
+            snowflake_context = create_context(context, context_variables, event_details, metadata=metadata)
+            snowflake_context.init(file_key, etag=record.get("s3").get("object").get("eTag"))
+            rules = RulesFactory.build_rules(snowflake_context)
+            logger.info(f"Found {len(rules)} rules configured for {event_type} "
+                        f"of {record.get('s3').get('object').get('key')}")
+            RuleEngine(max_workers=int(context_variables.get("RULE_ENGINE_MAX_WORKERS", 4))).run(
+                rules, snowflake_context, record.get("s3"))
+        except Exception as ex:
+            logger.error(f"While processing {file_key} exception is raised as {ex}")
+            traceback.print_exc()
+            # configuration errors stay in the landing bucket like transient ones, but retrying them does not help
+            outcome.update(status="FAILED" if snowflake_context else
+                           "MISCONFIGURED" if isinstance(ex, ConfigurationError) else "ERROR", error=f"{ex}")
+            if snowflake_context:
+                try:
+                    snowflake_context.mark_failed(file_key)
+                except Exception as mark_ex:
+                    logger.error(f"Could not mark {file_key} as failed, exception is raised as {mark_ex}")
+                    traceback.print_exc()
+                    outcome.update(status="ERROR", error=f"{mark_ex}")
+            return outcome
+        try:
+            snowflake_context.mark_success(file_key)
+            outcome["status"] = "SUCCESS"
+        except Exception as ex:
+            logger.error(f"Could not mark {file_key} as success, exception is raised as {ex}")
+            traceback.print_exc()
+            outcome.update(status="ERROR", error=f"{ex}")
+    else:
+        logger.warning(f"No Even handing is defined for {record.get('eventName')} events or "
+                       f"folders are recognize as objects ,Ignoring {file_key}")
+    return outcome
+
+
 def run(event, context):
     logger.info(f"Received event {json.dumps(event)} for processing")
+    metrics.start_invocation()
     events_mappings = json.loads(os.environ.get("events_mappings", "{}"))
     context_variables = json.loads(os.environ.get("context_variables", "{}"))
-    secrets = get_secrets(context_variables.get("SNOWFLAKE_SECRET_ARN"))
-    for record in event.get("Records", []):
-        snowflake_context = False
-        if record.get("eventSource", "") == "aws:s3" and record.get("eventName", "").split(":")[0] == "ObjectCreated" \
-                and not(record.get("s3", {}).get("object", {}).get("key", "/").endswith("/"))\
-                and not(record.get("s3", {}).get("object", {}).get("key", "/").startswith("archives/")):
-            logger.info(f"Processing {record.get('eventName')} event for {record.get('s3').get('bucket').get('name')}/"
-                        f"{record.get('s3').get('object').get('key')}")
-            try:
-                event_type = events_mappings.get(record.get("s3").get("configurationId"), False)
-                if not event_type:
-                    raise Exception(f"Could not find event type mapped to the configuration id "
-                                    f"{record.get('s3').get('configurationId')}")
-                event_details = {"event_source": record.get("s3").get("bucket").get("name"),
-                                 "event_key": f"{'/'.join(record.get('s3').get('object').get('key').split('/')[:-1])}",
-                                 "event_type": event_type}
-                logger.info(f"Creating snowflake context for the file processing with {event_details}")
-                snowflake_context = SnowflakeContext(context=context, variables=context_variables, **secrets,
-                                                     **event_details)
-                snowflake_context.init(f"{record.get('s3').get('bucket').get('name')}/"
-                                       f"{record.get('s3').get('object').get('key')}")
-                rules = RulesFactory.build_rules(snowflake_context)
-                logger.info(f"Found {len(rules)} rules configured for {event_type} "
-                            f"of {record.get('s3').get('object').get('key')}")
-                for rule in rules:
-                    rule.apply(snowflake_context, record.get("s3"))
-            except Exception as ex:
-                logger.error(f"While processing {record.get('s3').get('bucket').get('name')}/"
-                             f"{record.get('s3').get('object').get('key')} exception is raised as {ex}")
-                traceback.print_exc()
-                if snowflake_context:
-                    snowflake_context.mark_failed(f"{record.get('s3').get('bucket').get('name')}/"
-                                                  f"{record.get('s3').get('object').get('key')}")
-                continue
-            snowflake_context.mark_success(f"{record.get('s3').get('bucket').get('name')}/"
-                                           f"{record.get('s3').get('object').get('key')}")
+    records = event.get("Records", [])
+    # an event with nothing to process never touches Secrets Manager or Snowflake. Otherwise the secret is read once
+    # here so the invocation fails early when it can not be, the records read it again from the cache
+    prefetched = {}
+    if any(is_processable(record) for record in records):
+        get_secrets(context_variables.get("SNOWFLAKE_SECRET_ARN"))
+        prefetched = prefetch_metadata(records, events_mappings, context_variables)
+    workers = min(int(context_variables.get("RECORD_PROCESSING_WORKERS", 1)), len(records))
+    process = partial(process_record, context=context, events_mappings=events_mappings,
+                      context_variables=context_variables, prefetched=prefetched)
+    if workers > 1:
+        logger.info(f"Processing {len(records)} records with {workers} workers")
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # map keeps the outcomes in the order of the records in the event
+            outcomes = list(executor.map(process, records))
+    else:
+        outcomes = [process(record) for record in records]
+    for outcome in outcomes:
+        logger.info(f"{outcome['record']}: {outcome['status']}"
+                    f"{' - ' + outcome['error'] if outcome['error'] else ''}")
+    logger.info(f"Snowflake sessions opened by this execution environment: {connection_manager.handshakes}, "
+                f"handshakes avoided by reuse: {connection_manager.handshakes_avoided}, "
+                f"secrets fetched: {secrets_cache.fetches}, served from cache: {secrets_cache.hits}")
+    statuses = [outcome["status"] for outcome in outcomes]
+    metrics.emit_summary(Records=len(outcomes), **{status.title().replace("_", ""): statuses.count(status)
+                                                   for status in ("SUCCESS", "FAILED", "ERROR", "MISCONFIGURED",
+                                                                  "IGNORED", "DUPLICATE", IN_PROGRESS)})
+    return {"records": outcomes}
 
-        else:
-            logger.warning(f"No Even handing is defined for {record.get('eventName')} events or "
-                           f"folders are recognize as objects ,Ignoring "
-                           f"{record.get('s3').get('bucket').get('name')}/{record.get('s3').get('object').get('key')}")
+
+def unwrap_sqs_message(message):
+    # the body is an S3 notification, either sent to the queue directly or wrapped in an SNS envelope
+    body = json.loads(message.get("body") or "{}")
+    if body.get("Type") == "Notification" and "Message" in body:
+        body = json.loads(body["Message"])
+    if body.get("Event") == "s3:TestEvent":
+        logger.info(f"Ignoring S3 test event in message {message.get('messageId')}")
+        return []
+    return body.get("Records", [])
+
+
+def run_sqs(event, context):
+    # Entry point for an SQS event source mapping with ReportBatchItemFailures enabled. The records of every message
+    # are processed as one batch and only the messages whose records could not be completed, or are still being
+    # processed by another invocation, are reported back, so SQS redelivers those alone. Files rejected by a rule are
+    # already moved to the rejection bucket and are not retried, neither are MISCONFIGURED records which stay in the
+    # landing bucket until the configuration is fixed.
+    messages = event.get("Records", [])
+    records, owners, failed = [], [], set()
+    for message in messages:
+        try:
+            message_records = unwrap_sqs_message(message)
+        except Exception as ex:
+            logger.error(f"Could not parse the body of message {message.get('messageId')}: {ex}")
+            failed.add(message.get("messageId"))
+            continue
+        records.extend(message_records)
+        owners.extend([message.get("messageId")] * len(message_records))
+    logger.info(f"Unwrapped {len(records)} S3 records from {len(messages)} SQS messages")
+    outcomes = run({"Records": records}, context)["records"] if records else []
+    for owner, outcome in zip(owners, outcomes):
+        if outcome["status"] in ("ERROR", IN_PROGRESS):
+            failed.add(owner)
+    failures = [{"itemIdentifier": message.get("messageId")} for message in messages
+                if message.get("messageId") in failed]
+    logger.info(f"{len(failures)} of {len(messages)} SQS messages reported as failed")
+    return {"batchItemFailures": failures}
 
 
 if __name__ == "__main__":
@@ -0,0 +1,99 @@
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+NAMESPACE = os.environ.get("METRICS_NAMESPACE", "DataPlatform/S3EventHandler")
+
+
+class MetricsRecorder:
+    # Emits one CloudWatch Embedded Metric Format line per timed operation. The lines go straight to stdout, the log
+    # formatter would otherwise prefix them and CloudWatch would no longer extract the metrics. Durations are also
+    # aggregated per operation for the invocation summary.
+
+    def __init__(self, namespace=NAMESPACE, stream=None):
+        self._namespace = namespace
+        self._stream = stream
+        self._lock = threading.Lock()
+        self._summary = {}
+        self._started_at = time.monotonic()
+
+    def _write(self, payload):
+        stream = self._stream or sys.stdout
+        with self._lock:
+            stream.write(json.dumps(payload, default=str) + "\n")
+            stream.flush()
+
+    def emit(self, component, operation, duration_ms, outcome, bytes_touched=0, source_name=None,
+             generic_file_name=None):
+        self._write({"_aws": {"Timestamp": int(time.time() * 1000),
+                              "CloudWatchMetrics": [{"Namespace": self._namespace,
+                                                     "Dimensions": [["Component", "Operation"],
+                                                                    ["Component", "Operation", "Outcome"],
+                                                                    ["Operation", "SourceName", "GenericFileName"]],
+                                                     "Metrics": [{"Name": "Duration", "Unit": "Milliseconds"},
+                                                                 {"Name": "BytesTouched", "Unit": "Bytes"}]}]},
+                     "Component": component,
+                     "Operation": operation,
+                     "Outcome": outcome,
+                     "SourceName": source_name or "unknown",
+                     "GenericFileName": generic_file_name or "unknown",
+                     "Duration": round(duration_ms, 3),
+                     "BytesTouched": bytes_touched})
+        with self._lock:
+            summary = self._summary.setdefault((component, operation), {"count": 0, "failures": 0, "duration_ms": 0.0,
+                                                                        "max_duration_ms": 0.0, "bytes": 0})
+            summary["count"] += 1
+            summary["failures"] += outcome != "SUCCESS"
+            summary["duration_ms"] += duration_ms
+            summary["max_duration_ms"] = max(summary["max_duration_ms"], duration_ms)
+            summary["bytes"] += bytes_touched
+
+    @contextmanager
+    def timer(self, component, operation, source_name=None, generic_file_name=None):
+        # the yielded dict lets the timed block report the bytes it read or wrote
+        measurement = {"bytes_touched": 0}
+        started = time.monotonic()
+        outcome = "SUCCESS"
+        try:
+            yield measurement
+        except Exception:
+            outcome = "FAILED"
+            raise
+        finally:
+            self.emit(component, operation, (time.monotonic() - started) * 1000, outcome,
+                      bytes_touched=measurement["bytes_touched"], source_name=source_name,
+                      generic_file_name=generic_file_name)
+
+    def start_invocation(self):
+        with self._lock:
+            self._summary = {}
+            self._started_at = time.monotonic()
+
+    def emit_summary(self, **counts):
+        # one line per invocation with the time spent per component, plus the per operation breakdown as a property
+        with self._lock:
+            summary, self._summary = self._summary, {}
+            duration_ms = (time.monotonic() - self._started_at) * 1000
+        components = {}
+        for (component, _), values in summary.items():
+            components[component] = components.get(component, 0.0) + values["duration_ms"]
+        self._write({"_aws": {"Timestamp": int(time.time() * 1000),
+                              "CloudWatchMetrics": [{"Namespace": self._namespace,
+                                                     "Dimensions": [[]],
+                                                     "Metrics": [{"Name": "InvocationDuration", "Unit": "Milliseconds"}] +
+                                                                [{"Name": f"{component}Duration", "Unit": "Milliseconds"}
+                                                                 for component in components] +
+                                                                [{"Name": name, "Unit": "Count"} for name in counts]}]},
+                     "InvocationDuration": round(duration_ms, 3),
+                     **{f"{component}Duration": round(value, 3) for component, value in components.items()},
+                     **counts,
+                     "Breakdown": {f"{component}/{operation}": {**values,
+                                                                "duration_ms": round(values["duration_ms"], 3),
+                                                                "max_duration_ms": round(values["max_duration_ms"], 3)}
+                                   for (component, operation), values in summary.items()}})
+
+
+metrics = MetricsRecorder()
@@ -1,17 +1,37 @@
 from abc import ABC
 from abc import abstractmethod
+import codecs
+import csv
+import json
 import re
 import logging
+import zlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import as_completed
 from datetime import datetime, timedelta
-import boto3
-import gzip
-import zipfile
-from io import BytesIO
+from clients import get_client
+from glue_batcher import glue_job_batcher
+from glue_batcher import start_job_run
+from metrics import metrics
+from transfer import IterReader
+from transfer import MB
+from transfer import MultipartStreamWriter
+from transfer import S3RangeReader
+from transfer import iter_gunzip
 
 logger = logging.getLogger()
 
+# how the rule engine schedules a rule: pure validations only look at the event, io validations query other systems
+# without changing anything, actions have side effects and run last in their configured order
+PURE_VALIDATION = "pure"
+IO_VALIDATION = "io"
+ACTION = "action"
+
 
 class RuleBase(ABC):
+    kind = ACTION
+
     def __init__(self, name, enabled=True, **kwargs):
         self._name = name
         self.enabled = enabled
@@ -50,25 +70,34 @@ class RuleBase(ABC):
                                 component_name=self.name,
                                 action=msg, action_status='SUCCESS')
 
+    def bytes_touched(self, context, data):
+        # bytes the rule read from or wrote to S3, reported with its metrics
+        return 0
+
     def apply(self, context, data):
-        try:
-            logger.info(f"{self.name}: Executing with {data}")
-            msg = self.do_execute(context, data)
-            self.on_success(context, data, msg)
-        except Exception as ex:
-            self.on_failure(context, data, ex)
+        with metrics.timer("Rule", self.name, source_name=context.config.get("source_name"),
+                           generic_file_name=context.config.get("generic_file_name")) as measurement:
+            try:
+                logger.info(f"{self.name}: Executing with {data}")
+                msg = self.do_execute(context, data)
+                measurement["bytes_touched"] = self.bytes_touched(context, data)
+                self.on_success(context, data, msg)
+            except Exception as ex:
+                self.on_failure(context, data, ex)
 
 
 class FilenamePatternRegexRule(RuleBase):
+    kind = PURE_VALIDATION
+
     def __init__(self, file_name_pattern, **kwargs):
         super().__init__(name="Filename Pattern Regex Rule", **kwargs)
         self._file_name_pattern = file_name_pattern
+        self._compiled_pattern = re.compile(file_name_pattern)
 
     def do_execute(self, context, data):
         logger.info(f"{self.name}: Pattern {self._file_name_pattern}")
-        file_name_pattern = re.compile(self._file_name_pattern)
         file_name = data.get('object', {}).get('key', "").split("/")[-1]
-        if file_name_pattern.fullmatch(file_name):
+        if self._compiled_pattern.fullmatch(file_name):
             return f"{data.get('bucket').get('name')}/{data.get('object').get('key')} name validate successfully."
         else:
             raise Exception(f"File name {file_name} does not fit the regex pattern "
@@ -76,6 +105,8 @@ class FilenamePatternRegexRule(RuleBase):
 
 
 class FilenameSizeRule(RuleBase):
+    kind = PURE_VALIDATION
+
     def __init__(self, min_file_size=1, max_file_size=None, **kwargs):
         super().__init__(name="File size Rule", **kwargs)
         self._min_file_size = min_file_size
@@ -91,91 +122,399 @@ class FilenameSizeRule(RuleBase):
 
 
 class FileDuplicationCheckRule(RuleBase):
-    def __init__(self, file_count=0, check_window={}, **kwargs):
+    kind = IO_VALIDATION
+
+    def __init__(self, file_count=0, check_window={}, match_etag=False, **kwargs):
         super().__init__(name="File duplication Rule", **kwargs)
         self._delta = timedelta(**check_window)
         self._file_count = file_count
+        self._match_etag = match_etag
 
     def do_execute(self, context, data):
-
-        if self._delta.total_seconds() > 0:
-            audit_events = context.get_audit_events(bucket_name=data.get("bucket").get("name"),
-                                                    file_path="/".join(data.get("object").get("key").split("/")[:-1]),
-                                                    file_name=data.get("object").get("key").split("/")[-1],
-                                                    component_name="Context",
-                                                    timestamp=(datetime.utcnow() - self._delta).strftime('%Y-%m-%d %H:%M:%S'),
-                                                    action_status="SUCCESS")
+        dedupe_index = context.dedupe_index
+        if dedupe_index:
+            found = dedupe_index.count(bucket=data.get("bucket").get("name"),
+                                       path="/".join(data.get("object").get("key").split("/")[:-1]),
+                                       name=data.get("object").get("key").split("/")[-1],
+                                       etag=data.get("object").get("eTag") if self._match_etag else None,
+                                       since=datetime.utcnow() - self._delta if self._delta.total_seconds() > 0 else None)
+        elif self._delta.total_seconds() > 0:
+            found = len(context.get_audit_events(bucket_name=data.get("bucket").get("name"),
+                                                 file_path="/".join(data.get("object").get("key").split("/")[:-1]),
+                                                 file_name=data.get("object").get("key").split("/")[-1],
+                                                 component_name="Context",
+                                                 timestamp=(datetime.utcnow() - self._delta).strftime('%Y-%m-%d %H:%M:%S'),
+                                                 action_status="SUCCESS"))
         else:
-            audit_events = context.get_audit_events(bucket_name=data.get("bucket").get("name"),
-                                                    file_path="/".join(data.get("object").get("key").split("/")[:-1]),
-                                                    file_name=data.get("object").get("key").split("/")[-1],
-                                                    component_name="Context", action_status="SUCCESS")
-        if len(audit_events) > self._file_count:
-            raise Exception(f"Found {len(audit_events)} past successful events for {data.get('bucket').get('name')}/{data.get('object').get('key')} ")
+            found = len(context.get_audit_events(bucket_name=data.get("bucket").get("name"),
+                                                 file_path="/".join(data.get("object").get("key").split("/")[:-1]),
+                                                 file_name=data.get("object").get("key").split("/")[-1],
+                                                 component_name="Context", action_status="SUCCESS"))
+        if found > self._file_count:
+            raise Exception(f"Found {found} past successful events for {data.get('bucket').get('name')}/{data.get('object').get('key')} ")
         else:
             return f"{data.get('bucket').get('name')}/{data.get('object').get('key')} does not have any successful event in given window."
 
 
+class HeaderSchemaCheckRule(RuleBase):
+    # Validates the header of a delimited file from a ranged GET of its first head_kb instead of the whole object.
+    # The expected columns come from the rule options or from the expected_columns_field column of the metadata row,
+    # as a JSON list or a comma separated string. Gzip files are validated on the inflated head of the archive. With
+    # footer_pattern set, the last tail_kb of an uncompressed file must end with a line matching the pattern, its
+    # first group being the row count, which is verified whenever the whole file fits in the head block.
+    kind = IO_VALIDATION
+
+    BOMS = ((codecs.BOM_UTF8, "utf-8-sig"), (codecs.BOM_UTF32_LE, "utf-32"), (codecs.BOM_UTF32_BE, "utf-32"),
+            (codecs.BOM_UTF16_LE, "utf-16"), (codecs.BOM_UTF16_BE, "utf-16"))
+
+    def __init__(self, expected_columns=None, expected_columns_field="expected_columns", head_kb=64, delimiter=None,
+                 encoding=None, case_sensitive=False, ordered=True, allow_extra_columns=False, footer_pattern=None,
+                 tail_kb=4, **kwargs):
+        super().__init__(name="Header Schema Check Rule", **kwargs)
+        self._expected_columns = expected_columns
+        self._expected_columns_field = expected_columns_field
+        self._head_size = int(head_kb * 1024)
+        self._delimiter = delimiter
+        self._encoding = encoding
+        self._case_sensitive = case_sensitive
+        self._ordered = ordered
+        self._allow_extra_columns = allow_extra_columns
+        self._footer_pattern = re.compile(footer_pattern) if footer_pattern else None
+        self._tail_size = int(tail_kb * 1024)
+
+    def bytes_touched(self, context, data):
+        size = int(data.get("object").get("size", 0))
+        tail = self._tail_size if self._footer_pattern and size > self._head_size else 0
+        return min(size, self._head_size) + min(tail, size)
+
+    def _columns(self, value):
+        if isinstance(value, str):
+            value = json.loads(value) if value.strip().startswith("[") else value.split(",")
+        return [column.strip() if self._case_sensitive else column.strip().lower() for column in value]
+
+    def _decode(self, block, final):
+        for bom, encoding in self.BOMS:
+            if block.startswith(bom):
+                return encoding, codecs.getincrementaldecoder(encoding)().decode(block, final=final)
+        try:
+            return "utf-8", codecs.getincrementaldecoder("utf-8")().decode(block, final=final)
+        except UnicodeDecodeError:
+            return "cp1252", block.decode("cp1252", errors="replace")
+
+    def _complete_lines(self, text, final):
+        lines = text.splitlines()
+        # the last line of a partial block is usually cut in the middle
+        return lines if final or text.endswith(("\n", "\r")) else lines[:-1]
+
+    def do_execute(self, context, data):
+        bucket, key = data.get('bucket').get('name'), data.get('object').get('key')
+        size = int(data.get("object").get("size", 0))
+        expected = self._expected_columns or context.config.get(self._expected_columns_field)
+        if not expected:
+            raise Exception(f"No expected columns configured for {bucket}/{key}, set expected_columns on the rule "
+                            f"or the {self._expected_columns_field} column of the metadata")
+        s3 = get_client("s3")
+        block = s3.get_object(Bucket=bucket, Key=key, Range=f"bytes=0-{self._head_size - 1}")["Body"].read()
+        whole_file = len(block) >= size
+        compressed = key.endswith(".gz") or context.config.get("file_type", "") == "gz"
+        if compressed:
+            inflater = zlib.decompressobj(zlib.MAX_WBITS | 16)
+            block = inflater.decompress(block, self._head_size)
+            whole_file = whole_file and inflater.eof
+        encoding, text = self._decode(block, final=whole_file)
+        if self._encoding and codecs.lookup(encoding).name != codecs.lookup(self._encoding).name:
+            raise Exception(f"{bucket}/{key} is encoded as {encoding}, expecting {self._encoding}")
+        lines = [line for line in self._complete_lines(text, whole_file) if line.strip()]
+        if not lines:
+            raise Exception(f"No complete header line found in the first {self._head_size} bytes of {bucket}/{key}")
+        delimiter = self._delimiter or context.config.get("delimiter")
+        if not delimiter:
+            try:
+                delimiter = csv.Sniffer().sniff("\n".join(lines[:20]), delimiters=",;|\t").delimiter
+            except csv.Error:
+                delimiter = max(",;|\t", key=lines[0].count)
+        header = self._columns(next(csv.reader([lines[0]], delimiter=delimiter)))
+        expected = self._columns(expected)
+        missing = [column for column in expected if column not in header]
+        unexpected = [column for column in header if column not in expected]
+        if missing or (unexpected and not self._allow_extra_columns):
+            raise Exception(f"Header of {bucket}/{key} does not match the expected columns, missing {missing}, "
+                            f"unexpected {unexpected}")
+        if self._ordered and [column for column in header if column in expected] != expected:
+            raise Exception(f"Columns of {bucket}/{key} are not in the expected order {expected}, found {header}")
+        if self._footer_pattern and not compressed:
+            self._check_footer(s3, bucket, key, size, lines if whole_file else None)
+        return (f"{bucket}/{key} header matches {len(expected)} expected columns "
+                f"(encoding {encoding}, delimiter {delimiter!r}).")
+
+    def _check_footer(self, s3, bucket, key, size, lines):
+        if lines is None:
+            tail = s3.get_object(Bucket=bucket, Key=key, Range=f"bytes=-{self._tail_size}")["Body"].read()
+            _, text = self._decode(tail, final=True)
+            # the first line of the tail block is usually cut, only the last one is needed
+            footer = [line for line in text.splitlines() if line.strip()][-1:]
+        else:
+            footer = lines[-1:]
+        match = self._footer_pattern.fullmatch(footer[0].strip()) if footer else None
+        if not match:
+            raise Exception(f"Last line of {bucket}/{key} does not match the footer pattern "
+                            f"{self._footer_pattern.pattern}")
+        if match.groups() and lines is not None:
+            # header and footer are not data rows
+            rows = len(lines) - 2
+            if int(match.group(1)) != rows:
+                raise Exception(f"Footer of {bucket}/{key} declares {match.group(1)} rows, found {rows}")
+
+
 class CallGlueJob(RuleBase):
-    def __init__(self, job_name, **kwargs):
+    # With batch_max_files above 1 the files of concurrently processed records are coalesced into one job run that
+    # receives a manifest of their paths in --manifest_path instead of --file_path, see glue_batcher. Jobs have to
+    # read the manifest to opt in. Manifests are written under manifest_path, by default the archives/ prefix of the
+    # landing bucket which the handler ignores. A batch only fills from records processed at the same time, so with
+    # RECORD_PROCESSING_WORKERS at 1 every file is started on its own run instead of waiting for a window alone.
+    def __init__(self, job_name, batch_max_files=1, batch_window_seconds=None, manifest_path=None, max_attempts=5,
+                 backoff_seconds=1, **kwargs):
         super(CallGlueJob, self).__init__(name="Glue Job Rule", **kwargs)
         self._job_name = job_name
+        self._batch_max_files = batch_max_files
+        self._batch_window_seconds = batch_window_seconds
+        self._manifest_path = manifest_path
+        self._max_attempts = max_attempts
+        self._backoff_seconds = backoff_seconds
 
     def do_execute(self, context, data):
         logger.info(f"{self.name}: Calling glue job: {self._job_name}")
-        glue = boto3.client('glue')
-        try:
-            job_args = {f"--{key}": value for key,value in context.config.items() if key not in ["on_landing",
-                                                                                                 "on_ingestion"] and
-                        value is not None}
-            for key, value in self._args.items():
-                job_args[f"--{key}"] = value
-            job_args["--file_path"] = f"s3://{data.get('bucket').get('name')}/{data.get('object').get('key')}"
-            run_id = glue.start_job_run(JobName=self._job_name, Arguments=job_args)
+        job_args = {f"--{key}": value for key,value in context.config.items() if key not in ["on_landing",
+                                                                                             "on_ingestion"] and
+                    value is not None}
+        for key, value in self._args.items():
+            job_args[f"--{key}"] = value
+        file_path = f"s3://{data.get('bucket').get('name')}/{data.get('object').get('key')}"
+        batching = self._batch_max_files > 1
+        if batching and int(context.variables.get("RECORD_PROCESSING_WORKERS", 1)) <= 1:
+            logger.warning(f"{self.name}: batch_max_files is {self._batch_max_files} but records are not processed "
+                           f"concurrently, starting {self._job_name} without batching. Raise "
+                           f"RECORD_PROCESSING_WORKERS to coalesce job runs")
+            batching = False
+        if batching:
+            manifest_path = self._manifest_path or f"s3://{data.get('bucket').get('name')}/archives/glue-manifests"
+            run_id = glue_job_batcher.submit(self._job_name, job_args, file_path, manifest_path,
+                                             max_files=self._batch_max_files,
+                                             window_seconds=self._batch_window_seconds,
+                                             max_attempts=self._max_attempts,
+                                             backoff_seconds=self._backoff_seconds).result()
             logger.info(f"{self.name}: Glue job run id is {run_id}")
-        except Exception as ex:
-            raise ex
+            return f"Glue job {self._job_name}, successfully invoked in a batch with {data.get('bucket').get('name')}/{data.get('object').get('key')}"
+        job_args["--file_path"] = file_path
+        run_id = start_job_run(self._job_name, job_args, max_attempts=self._max_attempts,
+                               backoff_seconds=self._backoff_seconds)
+        logger.info(f"{self.name}: Glue job run id is {run_id}")
         return f"Glue job {self._job_name}, successfully invoked for {data.get('bucket').get('name')}/{data.get('object').get('key')}"
 
 
 class DecompressArchive(RuleBase):
-    def __init__(self, target_path, target_ext="csv", **kwargs):
+    def __init__(self, target_path, target_ext="csv", part_size_mb=8, max_concurrency=4, max_parallel_members=4,
+                 **kwargs):
         super(DecompressArchive, self).__init__(name="Decompress Archive", **kwargs)
         self._target_path = target_path
         self._target_ext = target_ext
+        self._part_size = int(part_size_mb * MB)
+        self._max_concurrency = max_concurrency
+        self._max_parallel_members = max_parallel_members
+
+    def bytes_touched(self, context, data):
+        return int(data.get("object").get("size", 0))
+
+    @staticmethod
+    def _member_subfolder(target_file_name):
+        rgx_list = r'\d+\__|_?(\d+)|'
+        return (re.sub(rgx_list, "", target_file_name.split('.', 1)[0])).lower()
 
     def do_execute(self, context, data):
-        s3_client = s3 = boto3.client("s3")
-        s3_resource = boto3.resource('s3')
+        s3_client = s3 = get_client("s3")
 
         if context.config.get("file_type", "") == "gz":
             gzip_file_name = data.get('object').get('key').split("/")[-1]
             target_file_name = "{}{}".format(gzip_file_name.rstrip(".gz"),
                                              f".{self._target_ext}" if self._target_ext else "")
-            s3_client.upload_fileobj(Fileobj=gzip.GzipFile(None,
-                                                           "rb",
-                                                           fileobj=BytesIO(s3.get_object(
-                                                               Bucket=data.get('bucket').get('name'),
-                                                               Key=data.get('object').get('key'))['Body'].read())),
-                                     Bucket=self._target_path.split("/")[0],
-                                     Key=f"{'/'.join(self._target_path.split('/')[1:])}/{target_file_name}")
+            # S3 body stream -> incremental inflate -> multipart upload, download and upload overlap and
+            # memory is bounded by a few part sizes instead of the archive size
+            body = s3.get_object(Bucket=data.get('bucket').get('name'), Key=data.get('object').get('key'))['Body']
+            with MultipartStreamWriter(s3_client,
+                                       bucket=self._target_path.split("/")[0],
+                                       key=f"{'/'.join(self._target_path.split('/')[1:])}/{target_file_name}",
+                                       part_size=self._part_size,
+                                       max_concurrency=self._max_concurrency) as writer:
+                for block in iter_gunzip(body.iter_chunks(MB)):
+                    writer.write(block)
             return f"{data.get('bucket').get('name')}/{data.get('object').get('key')} is decompressed to " \
                    f"{self._target_path}/{target_file_name} successfully."
 
         elif context.config.get("file_type", "") == "zip":
-            zip_obj = s3_resource.Object(bucket_name=data.get('bucket').get('name'), key=data.get('object').get('key'))
-            buffer = BytesIO(zip_obj.get()["Body"].read())
-            z = zipfile.ZipFile(buffer)
-            for target_file_name in z.namelist():
-                rgx_list = r'\d+\__|_?(\d+)|'
-                subfolder = (re.sub(rgx_list, "", target_file_name.split('.',1)[0])).lower()
-                s3_resource.meta.client.upload_fileobj(
-                    z.open(target_file_name),
-                    Bucket=self._target_path.split("/")[0],
-                    Key= f"{'/'.join(self._target_path.split('/')[1:])}/{subfolder}/{target_file_name}")
+            import zipfile
+            # zipfile reads the central directory and the member bytes through ranged GETs instead of downloading
+            # the whole archive, members are then extracted and uploaded concurrently
+            bucket, key = data.get('bucket').get('name'), data.get('object').get('key')
+            source = S3RangeReader(s3_client, bucket, key, size=data.get('object').get('size'))
+            target_file_names = zipfile.ZipFile(source).namelist()
+            if not target_file_names:
+                raise Exception(f"{bucket}/{key} is an empty archive")
+            workers = threading.local()
+
+            def extract(target_file_name):
+                if not hasattr(workers, "archive"):
+                    # zipfile serialises reads of a shared file, so every worker reads through its own archive
+                    workers.archive = zipfile.ZipFile(S3RangeReader(s3_client, bucket, key, size=source.size))
+                subfolder = self._member_subfolder(target_file_name)
+                with workers.archive.open(target_file_name) as member, \
+                        MultipartStreamWriter(s3_client,
+                                              bucket=self._target_path.split("/")[0],
+                                              key=f"{'/'.join(self._target_path.split('/')[1:])}/{subfolder}/"
+                                                  f"{target_file_name}",
+                                              part_size=self._part_size,
+                                              max_concurrency=self._max_concurrency) as writer:
+                    for block in iter(lambda: member.read(MB), b""):
+                        writer.write(block)
+
+            with ThreadPoolExecutor(max_workers=max(1, min(self._max_parallel_members,
+                                                           len(target_file_names)))) as executor:
+                futures = [executor.submit(extract, name) for name in target_file_names]
+                for future in as_completed(futures):
+                    if future.exception():
+                        for pending in futures:
+                            pending.cancel()
+                        raise future.exception()
+            target_file_name = target_file_names[-1]
+            subfolder = self._member_subfolder(target_file_name)
             return f"{data.get('bucket').get('name')}/{data.get('object').get('key')} is decompressed to " \
                    f"{self._target_path}/{subfolder}/{target_file_name} successfully."
         else:
             raise Exception(f"File extention {context.config.get('file_type', '')} "
                             f"is not supported or recognised as archive type")
-    
+
+
+class ConvertColumnarRule(RuleBase):
+    # Converts a landed csv, or the csv of a gz or every member of a zip archive with one of member_extensions, to
+    # Parquet under target_path, other members such as a manifest or readme are skipped. The file is parsed in blocks
+    # of block_kb and written in row groups of up to row_group_rows rows through a multipart upload, so memory stays
+    # bounded by one row group whatever the size of the file. Columns and types come from the rule's
+    # schema option or from the schema_field column of the metadata row, as a JSON object or list of [name, type]
+    # pairs, e.g. {"id": "bigint", "amount": "decimal(18,2)", "loaded_at": "timestamp"}. pyarrow is imported on first
+    # use, so it is only needed in the deployment package when the rule is configured.
+    TYPES = {"string": "string", "varchar": "string", "text": "string", "char": "string", "int": "int64",
+             "integer": "int64", "bigint": "int64", "smallint": "int32", "float": "float64", "double": "float64",
+             "real": "float32", "boolean": "bool", "bool": "bool", "date": "date32", "timestamp": "timestamp[ms]",
+             "datetime": "timestamp[ms]"}
+
+    def __init__(self, target_path, schema=None, schema_field="columnar_schema", compression="snappy",
+                 compression_level=None, delimiter=None, block_kb=1024, row_group_rows=131072, part_size_mb=8,
+                 max_concurrency=4, member_extensions=("csv", "txt"), **kwargs):
+        super(ConvertColumnarRule, self).__init__(name="Convert Columnar", **kwargs)
+        if compression not in ("snappy", "zstd", "gzip", "none"):
+            raise Exception(f"Parquet compression {compression} is not supported, expecting snappy, zstd, gzip "
+                            f"or none")
+        self._target_path = target_path
+        self._schema = schema
+        self._schema_field = schema_field
+        self._compression = compression
+        self._compression_level = compression_level
+        self._delimiter = delimiter
+        self._block_size = int(block_kb * 1024)
+        self._row_group_rows = row_group_rows
+        self._part_size = int(part_size_mb * MB)
+        self._max_concurrency = max_concurrency
+        self._member_extensions = tuple(f".{extension.lower().lstrip('.')}" for extension in member_extensions)
+
+    def bytes_touched(self, context, data):
+        return int(data.get("object").get("size", 0))
+
+    def _arrow_schema(self, pa, bucket, key, schema):
+        if not schema:
+            raise Exception(f"No columnar schema configured for {bucket}/{key}, set schema on the rule or the "
+                            f"{self._schema_field} column of the metadata")
+        if isinstance(schema, str):
+            schema = json.loads(schema)
+        fields = []
+        for name, type_name in (schema.items() if isinstance(schema, dict) else schema):
+            type_name = type_name.strip().lower()
+            decimal = re.fullmatch(r"(?:decimal|numeric|number)\s*\(\s*(\d+)\s*(?:,\s*(\d+)\s*)?\)", type_name)
+            try:
+                arrow_type = pa.decimal128(int(decimal.group(1)), int(decimal.group(2) or 0)) if decimal else \
+                    pa.type_for_alias(self.TYPES.get(type_name, type_name))
+            except ValueError:
+                raise Exception(f"Type {type_name} of column {name} is not supported for {bucket}/{key}")
+            fields.append(pa.field(name, arrow_type))
+        return pa.schema(fields)
+
+    def _convert(self, s3_client, source, schema, target_key):
+        import pyarrow as pa
+        import pyarrow.csv as pa_csv
+        import pyarrow.parquet as pq
+        reader = pa_csv.open_csv(source,
+                                 read_options=pa_csv.ReadOptions(block_size=self._block_size),
+                                 parse_options=pa_csv.ParseOptions(delimiter=self._delimiter or ","),
+                                 convert_options=pa_csv.ConvertOptions(column_types=schema,
+                                                                       include_columns=schema.names))
+        rows, pending, pending_rows = 0, [], 0
+        with MultipartStreamWriter(s3_client, bucket=self._target_path.split("/")[0], key=target_key,
+                                   part_size=self._part_size, max_concurrency=self._max_concurrency) as target:
+            writer = pq.ParquetWriter(target, schema, compression=self._compression,
+                                      compression_level=self._compression_level)
+            try:
+                for batch in reader:
+                    pending.append(batch)
+                    pending_rows += batch.num_rows
+                    if pending_rows >= self._row_group_rows:
+                        # only whole row groups are written, the remainder starts the next one
+                        table = pa.Table.from_batches(pending, schema=schema)
+                        full = pending_rows - pending_rows % self._row_group_rows
+                        writer.write_table(table.slice(0, full), row_group_size=self._row_group_rows)
+                        pending, pending_rows, rows = table.slice(full).to_batches(), pending_rows - full, rows + full
+                if pending_rows or not rows:
+                    writer.write_table(pa.Table.from_batches(pending, schema=schema),
+                                       row_group_size=self._row_group_rows)
+                    rows += pending_rows
+            finally:
+                writer.close()
+        return rows
+
+    def do_execute(self, context, data):
+        try:
+            import pyarrow as pa
+        except ImportError:
+            raise Exception(f"{self.name} requires pyarrow in the deployment package or a layer")
+        s3_client = get_client("s3")
+        bucket, key = data.get('bucket').get('name'), data.get('object').get('key')
+        schema = self._arrow_schema(pa, bucket, key, self._schema or context.config.get(self._schema_field))
+        target_prefix = "/".join(self._target_path.split("/")[1:])
+        file_type = context.config.get("file_type", "")
+        if file_type == "zip":
+            import zipfile
+            # members are converted one after the other so memory stays at one row group
+            archive = zipfile.ZipFile(S3RangeReader(s3_client, bucket, key, size=data.get('object').get('size')))
+            # directories and the resource forks macOS adds under __MACOSX/ are never data
+            members = [name for name in archive.namelist() if not name.endswith("/") and
+                       not name.startswith("__MACOSX/") and name.lower().endswith(self._member_extensions)]
+            skipped = [name for name in archive.namelist() if not name.endswith("/") and name not in members]
+            if skipped:
+                logger.info(f"{self.name}: Skipping members of {bucket}/{key} that are not "
+                            f"{', '.join(self._member_extensions)} files: {skipped}")
+            if not members:
+                raise Exception(f"{bucket}/{key} has no {', '.join(self._member_extensions)} member to convert")
+            rows = 0
+            for member_name in members:
+                target_key = (f"{target_prefix}/{DecompressArchive._member_subfolder(member_name)}/"
+                              f"{member_name.rsplit('.', 1)[0]}.parquet")
+                with archive.open(member_name) as member:
+                    rows += self._convert(s3_client, member, schema, target_key)
+            return f"{bucket}/{key} is converted to {rows} Parquet rows in {len(members)} files under " \
+                   f"{self._target_path} successfully."
+        chunks = get_client("s3").get_object(Bucket=bucket, Key=key)["Body"].iter_chunks(MB)
+        file_name = key.split("/")[-1]
+        if file_type == "gz" or file_name.endswith(".gz"):
+            chunks = iter_gunzip(chunks)
+            file_name = file_name[:-len(".gz")] if file_name.endswith(".gz") else file_name
+        target_key = f"{target_prefix}/{file_name.rsplit('.', 1)[0]}.parquet"
+        rows = self._convert(s3_client, IterReader(chunks), schema, target_key)
+        return f"{bucket}/{key} is converted to {rows} Parquet rows in {self._target_path.split('/')[0]}/" \
+               f"{target_key} successfully."
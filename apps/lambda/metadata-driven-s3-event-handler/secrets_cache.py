@@ -0,0 +1,66 @@
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger()
+
+# Snowflake error numbers raised when the user, password or key pair is rejected, typically after a rotation. Older
+# connectors wrap the rejection in the generic 250001 connection failure, so the server message is matched as well.
+AUTHENTICATION_ERRNOS = {390100, 390144, 390318}
+
+
+def is_authentication_error(ex):
+    return getattr(ex, "errno", None) in AUTHENTICATION_ERRNOS or "Incorrect username or password" in str(ex)
+
+
+class SecretsCache:
+    # Process wide cache of Secrets Manager values keyed on (region, secret id, version stage). A single client per
+    # region backs every lookup, and a value is fetched again only once it is older than the TTL or a caller asks for
+    # a refresh after the secret was rejected. Refreshes within min_refresh_interval of the last fetch are served
+    # from the cache, so concurrent callers failing on the same rotated secret cause one fetch only.
+
+    def __init__(self, ttl=300, min_refresh_interval=5):
+        self._ttl = ttl
+        self._min_refresh_interval = min_refresh_interval
+        self._clients = {}
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.fetches = 0
+        self.hits = 0
+
+    def _client(self, region_name):
+        if region_name not in self._clients:
+            import boto3
+            self._clients[region_name] = boto3.session.Session().client(service_name="secretsmanager",
+                                                                        region_name=region_name)
+        return self._clients[region_name]
+
+    def get(self, secret_id, version_stage="AWSCURRENT", region_name=None, ttl=None, refresh=False):
+        key = (region_name, secret_id, version_stage)
+        ttl = self._ttl if ttl is None else ttl
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry:
+                age = time.monotonic() - entry["fetched_at"]
+                if age < (self._min_refresh_interval if refresh else ttl):
+                    self.hits += 1
+                    return dict(entry["value"])
+            response = self._client(region_name).get_secret_value(SecretId=secret_id, VersionStage=version_stage)
+            self.fetches += 1
+            if entry and entry["version_id"] != response.get("VersionId"):
+                logger.info(f"Secret {secret_id} was rotated to version {response.get('VersionId')}")
+            entry = {"value": json.loads(response["SecretString"], strict=False),
+                     "version_id": response.get("VersionId"),
+                     "fetched_at": time.monotonic()}
+            self._entries[key] = entry
+            return dict(entry["value"])
+
+    def invalidate(self, secret_id=None):
+        with self._lock:
+            for key in [key for key in self._entries if secret_id is None or key[1] == secret_id]:
+                del self._entries[key]
+
+
+secrets_cache = SecretsCache(ttl=float(os.environ.get("SECRETS_CACHE_TTL_SECONDS", 300)))
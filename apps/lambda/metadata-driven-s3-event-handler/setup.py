@@ -8,5 +8,7 @@ setup(
     packages=find_packages(),
     entry_points={'dp.rules': ['s3.file_name_regex = rules:FilenamePatternRegexRule,'
                                          's3.file_size = rules:FilenameSizeRule',
-                                         's3.duplication_check = rules:FileDuplicationCheckRule']}
+                                         's3.duplication_check = rules:FileDuplicationCheckRule',
+                                         's3.schema_check = rules:HeaderSchemaCheckRule',
+                                         's3.convert_columnar = rules:ConvertColumnarRule']}
 )
@@ -0,0 +1,289 @@
+import io
+import logging
+import math
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger()
+
+MB = 1024 * 1024
+MIN_PART_SIZE = 5 * MB
+MAX_PARTS = 10000
+
+
+class MultipartStreamWriter:
+    # File like writer that streams bytes to S3 as a multipart upload. At most max_concurrency parts are in flight
+    # and one more is being filled, so memory stays at a few part sizes whatever the size of the object is.
+
+    def __init__(self, s3_client, bucket, key, part_size=8 * MB, max_concurrency=4, **extra_args):
+        if part_size < MIN_PART_SIZE:
+            raise Exception(f"Multipart part size must be at least {MIN_PART_SIZE} bytes, got {part_size}")
+        self._s3 = s3_client
+        self._bucket = bucket
+        self._key = key
+        self._part_size = part_size
+        self._max_concurrency = max_concurrency
+        self._extra_args = extra_args
+        self._buffer = bytearray()
+        self._futures = []
+        self._upload_id = None
+        self._executor = None
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self.bytes_written = 0
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type:
+            self.abort()
+        else:
+            self.close()
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self.bytes_written
+
+    def write(self, data):
+        self._buffer += data
+        self.bytes_written += len(data)
+        while len(self._buffer) >= self._part_size:
+            part = bytes(self._buffer[:self._part_size])
+            del self._buffer[:self._part_size]
+            self._submit(part)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def _submit(self, part):
+        if self._upload_id is None:
+            self._upload_id = self._s3.create_multipart_upload(Bucket=self._bucket, Key=self._key,
+                                                               **self._extra_args)["UploadId"]
+            self._executor = ThreadPoolExecutor(max_workers=self._max_concurrency)
+            logger.info(f"Started multipart upload {self._upload_id} for {self._bucket}/{self._key}")
+        for future in self._futures:
+            if future.done() and future.exception():
+                raise future.exception()
+        # blocks the producer while max_concurrency parts are still uploading
+        self._slots.acquire()
+        self._futures.append(self._executor.submit(self._upload_part, len(self._futures) + 1, part))
+
+    def _upload_part(self, part_number, body):
+        try:
+            response = self._s3.upload_part(Bucket=self._bucket, Key=self._key, UploadId=self._upload_id,
+                                            PartNumber=part_number, Body=body)
+            return {"PartNumber": part_number, "ETag": response["ETag"]}
+        finally:
+            self._slots.release()
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self._upload_id is None:
+                self._s3.put_object(Bucket=self._bucket, Key=self._key, Body=bytes(self._buffer), **self._extra_args)
+            else:
+                if self._buffer:
+                    self._submit(bytes(self._buffer))
+                parts = [future.result() for future in self._futures]
+                self._s3.complete_multipart_upload(Bucket=self._bucket, Key=self._key, UploadId=self._upload_id,
+                                                   MultipartUpload={"Parts": parts})
+                logger.info(f"Completed multipart upload of {len(parts)} parts for {self._bucket}/{self._key}")
+        except Exception:
+            self.abort()
+            raise
+        finally:
+            self._release()
+
+    def abort(self):
+        if self.closed:
+            return
+        try:
+            if self._upload_id is not None:
+                for future in self._futures:
+                    future.cancel()
+                self._executor.shutdown(wait=True)
+                logger.warning(f"Aborting multipart upload {self._upload_id} for {self._bucket}/{self._key}")
+                self._s3.abort_multipart_upload(Bucket=self._bucket, Key=self._key, UploadId=self._upload_id)
+        finally:
+            self._release()
+
+    def _release(self):
+        self.closed = True
+        self._buffer = bytearray()
+        if self._executor:
+            self._executor.shutdown(wait=True)
+
+
+class S3RangeReader(io.RawIOBase):
+    # Seekable, read only file object over an S3 object where every read is served by a ranged GET, so zipfile only
+    # pulls the central directory and the members it extracts. Reads are fetched in blocks of at least block_size
+    # to keep zipfile's small header reads from turning into one request each.
+
+    def __init__(self, s3_client, bucket, key, size=None, block_size=MB):
+        super().__init__()
+        self._s3 = s3_client
+        self._bucket = bucket
+        self._key = key
+        self._block_size = block_size
+        self.size = int(size) if size is not None else s3_client.head_object(Bucket=bucket, Key=key)["ContentLength"]
+        self._pos = 0
+        self._block_start = 0
+        self._block = b""
+        self.requests = 0
+        self.bytes_fetched = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self._pos + offset
+        elif whence == io.SEEK_END:
+            position = self.size + offset
+        else:
+            raise ValueError(f"Invalid whence {whence}")
+        if position < 0:
+            raise ValueError(f"Negative seek position {position}")
+        self._pos = position
+        return self._pos
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.size - self._pos
+        size = min(size, self.size - self._pos)
+        if size <= 0:
+            return b""
+        offset = self._pos - self._block_start
+        if offset < 0 or offset + size > len(self._block):
+            end = min(self._pos + max(size, self._block_size), self.size) - 1
+            self._block = self._s3.get_object(Bucket=self._bucket, Key=self._key,
+                                              Range=f"bytes={self._pos}-{end}")["Body"].read()
+            self._block_start = self._pos
+            self.requests += 1
+            self.bytes_fetched += len(self._block)
+            offset = 0
+        data = self._block[offset:offset + size]
+        self._pos += len(data)
+        return data
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+
+class IterReader(io.RawIOBase):
+    # Read only file object over an iterator of byte blocks, such as a body's iter_chunks or iter_gunzip, so
+    # consumers expecting a file read the stream without it being buffered whole
+
+    def __init__(self, chunks):
+        super().__init__()
+        self._chunks = iter(chunks)
+        self._pending = memoryview(b"")
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self._pending:
+            block = next(self._chunks, None)
+            if block is None:
+                return 0
+            self._pending = memoryview(block)
+        size = min(len(buffer), len(self._pending))
+        buffer[:size] = self._pending[:size]
+        self._pending = self._pending[size:]
+        return size
+
+
+def _multipart_copy(s3_client, copy_source, head, bucket, key, part_size, executor):
+    size = head["ContentLength"]
+    part_size = max(part_size, math.ceil(size / MAX_PARTS))
+    create_args = {"Metadata": head.get("Metadata", {})}
+    if head.get("ContentType"):
+        create_args["ContentType"] = head["ContentType"]
+    upload_id = s3_client.create_multipart_upload(Bucket=bucket, Key=key, **create_args)["UploadId"]
+    # every part is copied from the same version of the source
+    source_guard = {"CopySourceIfMatch": head["ETag"]} if head.get("ETag") else {}
+    futures = []
+    try:
+        futures = [executor.submit(s3_client.upload_part_copy, Bucket=bucket, Key=key, UploadId=upload_id,
+                                   PartNumber=number, CopySource=copy_source,
+                                   CopySourceRange=f"bytes={start}-{min(start + part_size, size) - 1}", **source_guard)
+                   for number, start in enumerate(range(0, size, part_size), start=1)]
+        parts = [{"PartNumber": number, "ETag": future.result()["CopyPartResult"]["ETag"]}
+                 for number, future in enumerate(futures, start=1)]
+        s3_client.complete_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id,
+                                            MultipartUpload={"Parts": parts})
+    except Exception:
+        for future in futures:
+            future.cancel()
+        s3_client.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+        raise
+
+
+def fan_out_move(s3_client, source_bucket, source_key, destinations, multipart_threshold=64 * MB, part_size=64 * MB,
+                 max_concurrency=10):
+    # Server side copies of one object to every (bucket, key) in destinations, issued concurrently. Objects below
+    # multipart_threshold are copied with a single copy_object request, larger ones with parallel upload_part_copy.
+    # The source is deleted only after every copy is confirmed, a failed copy leaves it in place.
+    head = s3_client.head_object(Bucket=source_bucket, Key=source_key)
+    size = head["ContentLength"]
+    copy_source = {"Bucket": source_bucket, "Key": source_key}
+    logger.info(f"Moving {source_bucket}/{source_key} ({size} bytes) to "
+                f"{', '.join(f'{bucket}/{key}' for bucket, key in destinations)}")
+    with ThreadPoolExecutor(max_workers=max(1, len(destinations))) as copies, \
+            ThreadPoolExecutor(max_workers=max_concurrency) as parts:
+        if size < multipart_threshold:
+            futures = [copies.submit(s3_client.copy_object, Bucket=bucket, Key=key, CopySource=copy_source)
+                       for bucket, key in destinations]
+        else:
+            futures = [copies.submit(_multipart_copy, s3_client, copy_source, head, bucket, key, part_size, parts)
+                       for bucket, key in destinations]
+        errors = [future.exception() for future in futures if future.exception()]
+    if errors:
+        raise errors[0]
+    s3_client.delete_object(Bucket=source_bucket, Key=source_key)
+    return size
+
+
+def iter_gunzip(chunks, max_output=MB):
+    # Incrementally inflates gzip data (including concatenated members) without holding the archive in memory.
+    # Each yielded block is at most max_output bytes, so highly compressible input can not blow up the memory.
+    decompressor = None
+    for data in chunks:
+        while data:
+            if decompressor is None:
+                # zero padding is allowed between and after gzip members
+                data = data.lstrip(b"\x00")
+                if not data:
+                    break
+                decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+            block = decompressor.decompress(data, max_output)
+            if block:
+                yield block
+            if decompressor.eof:
+                data = decompressor.unused_data
+                decompressor = None
+            else:
+                data = decompressor.unconsumed_tail
+    if decompressor is not None:
+        block = decompressor.flush()
+        if block:
+            yield block
+        if not decompressor.eof:
+            raise EOFError("Compressed file ended before the end-of-stream marker was reached")